@@ -1,8 +1,11 @@
 from __future__ import absolute_import
+import sys
 import unittest
 
 # pylint: disable=W0614
 from tests.tests import *
+if sys.version_info >= (3, 5):
+  from tests.tests_async import *
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,52 @@
+"""Micro-benchmarks for the request hot path.
+
+Run with `python -m tests.bench`; results are printed, not asserted.
+"""
+from __future__ import absolute_import, print_function
+
+import timeit
+import tracemalloc
+
+from . import testbase
+import tinyaf
+
+
+def trivial_app():
+    app = tinyaf.App()
+    app.route("/", handler=lambda req, resp: "OK")
+    return app
+
+
+def bench_trivial_request(number=20000):
+    app = trivial_app()
+    environ = testbase.Request("/")._environ()
+    start_response = lambda status, headers: None
+    call = lambda: list(app(environ.copy(), start_response))
+
+    call()  # warm up
+    tracemalloc.start()
+    call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    secs = min(timeit.repeat(call, number=number, repeat=3))
+    print("trivial request: %.2f us/req, %i bytes peak allocation" % (secs / number * 1e6, peak))
+
+
+def bench_not_found(number=20000):
+    app = trivial_app()
+    environ = testbase.Request("/missing")._environ()
+    start_response = lambda status, headers: None
+    call = lambda: list(app(environ.copy(), start_response))
+    secs = min(timeit.repeat(call, number=number, repeat=3))
+    print("404 request: %.2f us/req" % (secs / number * 1e6))
+
+
+def bench_import(repeat=5):
+    best = min(testbase.import_time("import tinyaf")[1]['tinyaf'] for _ in range(repeat))
+    print("import tinyaf: %i us (-X importtime, cumulative)" % (best))
+
+
+if __name__ == '__main__':
+    bench_import()
+    bench_trivial_request()
+    bench_not_found()
@@ -5,6 +5,8 @@ import sys
 import functools
 import urllib
 import io
+import os
+import subprocess
 
 import tinyaf
 
@@ -37,6 +39,135 @@ BASE_ENV = {
 }
 
 
+def import_time(code):
+    """Run code in a fresh interpreter under `-X importtime`.
+
+    Returns (stdout, {module: cumulative microseconds}).
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', code], cwd=root,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    out, err = proc.communicate()
+    if proc.returncode:
+        raise RequestFailure("subprocess failed:\n%s" % (err))
+    times = {}
+    for line in err.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line.split('|')
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return out, times
+
+
+class EchoBackend(object):
+    """A keep-alive HTTP/1.1 server on localhost that echoes each request back as JSON.
+
+    `connections` counts accepted TCP connections, so tests can check reuse.
+    """
+    def __init__(self):
+        import http.server
+        import socketserver
+        import threading
+        backend = self
+        self.connections = 0
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                backend.connections += 1
+                http.server.BaseHTTPRequestHandler.setup(self)
+
+            def handle_any(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.dumps(dict(method=self.command, path=self.path,
+                                       headers=dict(self.headers.items()),
+                                       body=self.rfile.read(length).decode('utf-8'))).encode('utf-8')
+                self.send_response(201)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Keep-Alive', 'timeout=5')
+                self.send_header('X-Backend', 'echo')
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = do_PUT = handle_any
+
+            def log_message(self, *args):
+                pass
+
+        server_class = type('Server', (socketserver.ThreadingMixIn, http.server.HTTPServer),
+                            {'daemon_threads': True})
+        self.server = server_class(('127.0.0.1', 0), Handler)
+        self.url = "http://127.0.0.1:%i" % (self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class LiveServer(object):
+    """Runs app.make_server() on a localhost port in a background thread."""
+    def __init__(self, app):
+        import threading
+        self.server = app.make_server(port=0, host='127.0.0.1')
+        self.server.RequestHandlerClass.log_message = lambda *args: None
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class WebSocketClient(object):
+    """A bare-bones RFC 6455 client, for poking at the server one frame at a time."""
+    def __init__(self, port, path, headers=None):
+        import socket
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        request = ("GET %s HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                   "Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n" % (path))
+        for k, v in (headers or {}).items():
+            request += "%s: %s\r\n" % (k, v)
+        self.sock.sendall((request + "\r\n").encode('ascii'))
+        self.rfile = self.sock.makefile('rb')
+        self.status = self.rfile.readline().decode('ascii').split(' ')[1]
+        self.headers = {}
+        while True:
+            line = self.rfile.readline().decode('ascii').strip()
+            if not line: break
+            k, v = line.split(':', 1)
+            self.headers[k.strip().lower()] = v.strip()
+
+    def send_frame(self, opcode, payload=b'', fin=True, mask=b'\x01\x02\x03\x04'):
+        import struct
+        n = len(payload)
+        if n < 126: header = struct.pack('!BB', (0x80 if fin else 0) | opcode, 0x80 | n)
+        else: header = struct.pack('!BBQ', (0x80 if fin else 0) | opcode, 0x80 | 127, n)
+        masked = bytes(bytearray(b ^ bytearray(mask)[i % 4] for i, b in enumerate(bytearray(payload))))
+        self.sock.sendall(header + mask + masked)
+
+    def read_frame(self):
+        """Returns (opcode, payload), or None if the connection closed."""
+        import struct
+        head = self.rfile.read(2)
+        if len(head) < 2: return None
+        b0, b1 = bytearray(head)
+        n = b1 & 0x7f
+        if n == 126: n = struct.unpack('!H', self.rfile.read(2))[0]
+        elif n == 127: n = struct.unpack('!Q', self.rfile.read(8))[0]
+        return b0 & 0x0f, self.rfile.read(n)
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
 class RequestFailure(AssertionError):
     """Something went wrong with the WSGI protocol interaction."""
 
@@ -80,6 +211,8 @@ class Request(object):
         if not resp_info:  # Make sure start_reponse was called before return
             raise RequestFailure("start_response not called before handler returned")
         outlist = list(iter(out))  # coelesce down to list
+        if hasattr(out, 'close'):  # as every WSGI server must
+            out.close()
         # WSGI expects byte type only; no objects, unicode, iterators, etc.
         if not all(type(x) == BYTE_TYPE for x in outlist):
             types = list(set(type(x).__name__ for x in outlist))
@@ -1,5 +1,7 @@
 from __future__ import absolute_import
 
+import json
+import re
 import textwrap
 
 from . import testbase
@@ -78,14 +80,59 @@ class RouteTest(testbase.TinyAppTestBase):
         # check headers
         resp = testbase.Request('/g', postdata='foo').get_response(app)
         self.assertResponse(resp, 405)
-        self.assertEqual(resp.headers_dict['Allow'], 'GET')
+        self.assertEqual(resp.headers_dict['Allow'], 'GET,HEAD')
         resp = testbase.Request('/p', postdata=None).get_response(app)
         self.assertResponse(resp, 405)
         self.assertEqual(resp.headers_dict['Allow'], 'POST')
         # check multi-method header result
-        resp = testbase.Request('/', method='OPTIONS').get_response(app)
+        resp = testbase.Request('/', method='PUT').get_response(app)
         self.assertResponse(resp, 405)
-        self.assertEqual(resp.headers_dict['Allow'], 'GET,POST')
+        self.assertEqual(resp.headers_dict['Allow'], 'GET,HEAD,POST')
+
+    def test_head_and_options(self):
+        import os
+        calls = []
+        app = tinyaf.App()
+        app.route("/", methods=['GET'], handler=lambda req, resp: calls.append(req.method) or "hello")
+        app.route("/", methods=['POST'], handler=lambda req, resp: "posted")
+        app.route("/any", handler=lambda req, resp: req.method)
+        app.route("/file", methods=['GET'], handler=lambda req, resp: tinyaf.FileResponse(__file__))
+        resp = self.assertProducesResponse(app, "/", 200, "", method='HEAD')
+        self.assertEqual("5", resp.headers_dict['content-length'])  # what GET would have sent
+        self.assertEqual(['HEAD'], calls)
+        resp = self.assertProducesResponse(app, "/file", 200, "", method='HEAD')
+        self.assertEqual(str(os.path.getsize(__file__)), resp.headers_dict['content-length'])
+        resp = self.assertProducesResponse(app, "/file", 200)
+        self.assertEqual(os.path.getsize(__file__), len(resp.output()))
+        resp = self.assertProducesResponse(app, "/", 204, "", method='OPTIONS')
+        self.assertEqual('GET,HEAD,POST,OPTIONS', resp.headers_dict['Allow'])
+        self.assertEqual(['HEAD'], calls)  # OPTIONS never reached a handler
+        self.assertProducesResponse(app, "/any", 200, "OPTIONS", method='OPTIONS')  # took every method already
+        self.assertProducesResponse(app, "/nope", 404, method='OPTIONS')
+
+    def test_adaptive_routing(self):
+        app = tinyaf.App()
+        app.adaptive_routing, app.adaptive_interval = True, 10
+        app.route("/", handler=lambda req, resp: "root")
+        app.route("/users/<id>", methods=['GET'], handler=lambda req, resp: "user " + req['id'])
+        app.route("/users/me", methods=['GET', 'PUT'], handler=lambda req, resp: "me")  # shadowed for GET
+        app.route("/users/me", methods=['POST'], handler=lambda req, resp: "posted")
+        app.route("^/x(?P<n>[0-9]+)$", handler=lambda req, resp: "x" + req['n'])
+        app.route("/static/<name:.*>", handler=lambda req, resp: "static")
+        for _ in range(20):
+            self.assertProducesResponse(app, "/static/a.js", 200, "static")
+            self.assertProducesResponse(app, "/static/b.js", 200, "static")
+            self.assertProducesResponse(app, "/users/me", 200, "user me")
+            self.assertProducesResponse(app, "/users/me", 200, "me", method='PUT')
+        for _ in range(5):
+            self.assertProducesResponse(app, "/x12", 200, "x12")
+            self.assertProducesResponse(app, "/users/me", 200, "posted", postdata="x")
+        order = [(path, hits) for path, methods, hits in app.route_hits()]
+        self.assertEqual(("/static/<name:.*>", 40), order[0])
+        self.assertLess(order.index(("/users/<id>", 20)), order.index(("/users/me", 20)))
+        self.assertEqual(["^/x(?P<n>[0-9]+)$", "/"], [path for path, hits in order[-2:]])
+        self.assertEqual(6, len(order))
+        self.assertProducesResponse(app, "/", 200, "root")
 
     def test_separate_router(self):
         """Verify that external routers can be supplied to an app."""
@@ -104,6 +151,49 @@ class RouteTest(testbase.TinyAppTestBase):
         self.assertProducesResponse(app, "/nofind", 404, "Z")
         self.assertProducesResponse(app, "/bar", 200, "C")
 
+    def test_freeze(self):
+        """Verify frozen apps keep serving and refuse new registrations."""
+        r = tinyaf.Router()
+        r.route("/", handler=lambda req, resp: "A")
+        r.route("/opts", vars={'x': 'X'}, timeout=5, max_body=1, response_class=tinyaf.JsonResponse,
+                handler=lambda req, resp: resp.write({'x': req.vars['x'], 'left': round(req.time_remaining())}) or resp)
+        r.errorhandler(404, handler=lambda req, resp: "Z")
+        app = tinyaf.App(router=r).freeze()
+        self.assertTrue(all(entry[3] is not None for entry in app._table))  # options are precompiled
+        self.assertProducesResponse(app, "/", 200, "A")
+        self.assertProducesJson(app, "/opts", {'x': 'X', 'left': 5})
+        self.assertProducesResponse(app, "/opts", 413, postdata="xx", method='GET')
+        self.assertProducesResponse(app, "/nope", 404, "Z")
+        self.assertRaises(RuntimeError, app.route, "/b", lambda req, resp: "B")
+        self.assertRaises(RuntimeError, app.errorhandler, 404, lambda req, resp: "Z")
+        self.assertRaises(RuntimeError, r.route, "/c", lambda req, resp: "C")
+        self.assertProducesResponse(app, "/b", 404, "Z")
+        sibling = tinyaf.App(router=r)
+        self.assertRaises(RuntimeError, r.route, "/d", lambda req, resp: "D")
+        self.assertProducesResponse(sibling, "/d", 404)  # refused for every app using the router
+        self.assertProducesResponse(tinyaf.App(router=r), "/d", 404)
+
+    def test_register_while_serving(self):
+        """Verify routes added from another thread never disturb in-flight lookups."""
+        import threading
+        app = tinyaf.App()
+        app.route("/", handler=lambda req, resp: "A")
+        errors = []
+
+        def register():
+            for i in range(200):
+                app.route("/r%i" % i, handler=lambda req, resp: "R")
+
+        t = threading.Thread(target=register)
+        t.start()
+        while t.is_alive():
+            resp = testbase.Request("/").get_response(app)
+            if resp.code != 200: errors.append(resp.code)
+        t.join()
+        self.assertEqual([], errors)
+        self.assertEqual(201, len(app.routes))
+        self.assertProducesResponse(app, "/r199", 200, "R")
+
 
 class RequestTest(testbase.TinyAppTestBase):
     def test_url_vars(self):
@@ -165,6 +255,25 @@ class RequestTest(testbase.TinyAppTestBase):
         env = dict(QUERY_STRING='hello=world&foo=42')
         self.assertProducesJson(app, "/", dict(hello='world', foo='42'), env=env)
 
+    def test_query_args(self):
+        app = tinyaf.App()
+        app.route("/", handler=lambda req, _: tinyaf.JsonResponse(dict(
+            a=req.args['a'], all=req.args.getall('a'), n=req.args.get_int('n'),
+            bad=req.args.get_int('s', -1), missing=req.args.get('zz', 'dflt'), flag='flag' in req.args,
+            space=req.args.get('s'), fields=req.fields, same=req.args is req.args,
+            parsed_body=req._fieldstorage is not None)))
+        self.assertProducesJson(app, "/?a=1&a=2&n=42&flag&s=x+y%21&e=", dict(
+            a='1', all=['1', '2'], n=42, bad=-1, missing='dflt', flag=True, space='x y!',
+            fields={'a': ['1', '2'], 'n': '42', 's': 'x y!'}, same=True, parsed_body=False))
+
+    def test_query_args_post(self):
+        app = tinyaf.App()
+        app.route("/", handler=lambda req, _: tinyaf.JsonResponse(dict(
+            args=list(req.args), fields=req.fields)))
+        env = dict(CONTENT_TYPE="application/x-www-form-urlencoded")
+        self.assertProducesJson(app, "/?q=1", dict(args=['q'], fields=dict(q='1', b='2')),
+                                env=env, postdata="b=2")
+
     def test_headers(self):
         app = tinyaf.App()
         app.route("/", handler=lambda req, _: tinyaf.JsonResponse(dict(req.headers)))
@@ -178,6 +287,17 @@ class RequestTest(testbase.TinyAppTestBase):
             handler=lambda req, _: tinyaf.JsonResponse(dict(method=req.method, path=req.path)))
         self.assertProducesJson(app, "/foo/bar?baz", dict(method="GET", path="/foo/bar"))
 
+    def test_slots_allow_user_attrs(self):
+        app = tinyaf.App()
+
+        @app.route("/")
+        def _(req, resp):
+            req.user = "alice"  # not a slot; lands in the __dict__ escape hatch
+            return req.user
+
+        self.assertIn('path', tinyaf.Request.__slots__)
+        self.assertProducesResponse(app, "/", 200, "alice")
+
 
 class ResponseTest(testbase.TinyAppTestBase):
     def test_write(self):
@@ -226,6 +346,17 @@ class ResponseTest(testbase.TinyAppTestBase):
         self.assertEqual("text/html; charset=utf-8", r_def.headers_dict['content-type'])
         self.assertEqual("text/poem", r_alt.headers_dict['content-type'])
 
+    def test_status_lines(self):
+        app = tinyaf.App()
+        app.route("/ok", handler=lambda req, resp: "OK")
+        app.route("/odd", handler=lambda req, resp: tinyaf.Response(code=299))
+        app.route("/own", handler=lambda req, resp: tinyaf.Response(code=200, status="Fine"))
+        self.assertEqual("OK", testbase.Request("/ok").get_response(app).status)
+        self.assertEqual("Unknown", testbase.Request("/odd").get_response(app).status)
+        self.assertEqual("Fine", testbase.Request("/own").get_response(app).status)
+        self.assertEqual(("Not Found", "Nothing matches the given URI"),
+                         tinyaf.HttpError(404).http_status())
+
 
 class HandlingTest(testbase.TinyAppTestBase):
     def test_http_error(self):
@@ -264,6 +395,50 @@ class HandlingTest(testbase.TinyAppTestBase):
         resp = testbase.Request("/err").get_response(app)
         self.assertIn(SENTINEL, resp.output_str())
 
+    def test_lazy_traceback(self):
+        app = tinyaf.App()
+        app.tracebacks_to_stderr = False
+        errors = []
+        app.errorhandler(500, handler=lambda req, err: errors.append(err))
+
+        @app.route("/err")
+        def _(i, o):
+            raise ValueError("Boom!")
+
+        self.assertProducesResponse(app, "/err", 500)
+        self.assertNotIn('traceback', vars(errors[0]))  # nobody asked, so it was never formatted
+        self.assertIn("ValueError: Boom!", errors[0].traceback)
+        self.assertFalse(hasattr(tinyaf.HttpError(404), 'traceback'))
+
+    def test_default_error_pages(self):
+        app = tinyaf.App()
+        app.route("/", methods=['GET'], handler=lambda req, resp: "OK")
+        first = self.assertProducesResponse(app, "/a", 404)
+        second = self.assertProducesResponse(app, "/b", 404)
+        self.assertIs(first.output_list[0], second.output_list[0])  # the same cached bytes
+        self.assertIn("<h1>HTTP 404 - Not Found</h1>", first.output_str())
+        self.assertEqual(str(len(first.output())), first.headers_dict['content-length'])
+        resp = self.assertProducesResponse(app, "/", 405, method='PUT')
+        self.assertIn("<b>Method used:</b> PUT", resp.output_str())
+
+    def test_error_handler_raises(self):
+        app = tinyaf.App()
+
+        @app.errorhandler(404)
+        def _(req, err):
+            raise tinyaf.HttpError(410)
+
+        @app.errorhandler(500)
+        def _(req, err):
+            raise tinyaf.HttpError(500)  # would recurse forever
+
+        @app.route("/loop")
+        def _(req, resp):
+            raise tinyaf.HttpError(500)
+
+        self.assertProducesResponse(app, "/gone", 410)
+        self.assertProducesResponse(app, "/loop", 500)
+
 
 class RequestForwardTest(testbase.TinyAppTestBase):
     def test_wsgi_forward(self):
@@ -302,6 +477,966 @@ class RequestForwardTest(testbase.TinyAppTestBase):
         self.assertResponse(resp, 200, "Hello App 2")
         self.assertResponseHeaders(resp, {"App1": "OK", "App2": "OK"})
 
+    def test_forward_env(self):
+        app = tinyaf.App()
+        wsgi_app = lambda env, start_response: start_response("200 OK", []) or [env['X_FWD']]
+
+        @app.route("/")
+        def _(req, resp):
+            return req.forward(wsgi_app, env={'X_FWD': b"replaced"})
+
+        self.assertProducesResponse(app, "/", 200, "replaced")
+
+
+class ForwardHttpTest(testbase.TinyAppTestBase):
+    def setUp(self):
+        self.backend = testbase.EchoBackend()
+        self.app = tinyaf.App()
+
+        @self.app.route("^/")
+        def _(req, resp):
+            return req.forward_http(self.backend.url + "/base/", headers={"X-Added": "1"})
+
+    def tearDown(self):
+        self.backend.stop()
+
+    def test_forward_get(self):
+        env = dict(HTTP_CONNECTION="close, X-Secret", HTTP_X_SECRET="s", HTTP_X_KEPT="k")
+        resp = testbase.Request("/a/b?q=1", env=env).get_response(self.app)
+        self.assertResponse(resp, 201)
+        self.assertEqual("echo", resp.headers_dict["X-Backend"])
+        self.assertNotIn("Keep-Alive", resp.headers_dict)
+        echo = resp.output_json(validate=False)
+        self.assertEqual(("GET", "/base/a/b?q=1"), (echo['method'], echo['path']))
+        self.assertDictFuzzy({"X-Kept": "k", "X-Added": "1", "X-Forwarded-For": "127.0.0.1"},
+                             echo['headers'])
+        self.assertNotIn("x-secret", [k.lower() for k in echo['headers']])
+
+    def test_forward_post_and_reuse(self):
+        env = dict(CONTENT_TYPE="text/plain")
+        for i in range(3):
+            resp = testbase.Request("/p", postdata="body %i" % i, env=env).get_response(self.app)
+            echo = resp.output_json(validate=False)
+            self.assertEqual(("POST", "body %i" % i), (echo['method'], echo['body']))
+            self.assertDictFuzzy({"Content-Type": "text/plain"}, echo['headers'])
+        self.assertEqual(1, self.backend.connections)
+
+    def test_pool_limit(self):
+        app = tinyaf.App()
+        app.route("^/", handler=lambda req, resp: req.forward_http(self.backend.url, timeout=0.1, pool_size=1))
+        held = app(testbase.Request("/a")._environ(), lambda status, headers: None)  # not read yet
+        self.assertProducesResponse(app, "/b", 503)  # the only connection is in use
+        self.assertIn(b'"/a"', b"".join(held))
+        held.close()
+        self.assertResponse(testbase.Request("/c").get_response(app), 201)
+        self.assertEqual(1, self.backend.connections)
+        held = self.app(testbase.Request("/d")._environ(), lambda status, headers: None)
+        self.assertProducesResponse(app, "/e", 503)  # no pool_size given: the limit stays at 1
+        held.close()
+
+    def test_pool_slot_of_dropped_response(self):
+        app = tinyaf.App()
+
+        @app.route("^/")
+        def _(req, resp):
+            upstream = req.forward_http(self.backend.url, timeout=0.1, pool_size=1)
+            if req.args.get('drop'):
+                raise tinyaf.HttpError(502)  # the upstream response is never sent
+            return upstream
+
+        self.assertProducesResponse(app, "/a?drop=1", 502)
+        self.assertProducesResponse(app, "/b?drop=1", 502)
+        self.assertResponse(testbase.Request("/c").get_response(app), 201)
+
+    def test_upstream_down(self):
+        app = tinyaf.App()
+        app.route("/", handler=lambda req, resp: req.forward_http("http://127.0.0.1:9", timeout=2))
+        self.assertProducesResponse(app, "/", 502)
+
+
+class MountTest(testbase.TinyAppTestBase):
+    def test_mount_app(self):
+        app, child = tinyaf.App(), tinyaf.App()
+        app.route("/api/local", handler=lambda req, resp: "parent")
+        app.route("/apix", handler=lambda req, resp: "apix")
+        child.route("/local", handler=lambda req, resp: "child")
+        child.route("/env", handler=lambda req, resp: "%s|%s" % (
+            req.environ['SCRIPT_NAME'], req.environ['PATH_INFO']))
+        app.mount("/api/", child)
+        self.assertProducesResponse(app, "/api/local", 200, "child")  # mounts win over routes
+        self.assertProducesResponse(app, "/api/env", 200, "/api|/env")
+        self.assertProducesResponse(app, "/apix", 200, "apix")
+        self.assertProducesResponse(app, "/api/nope", 404)
+
+    def test_mount_wsgi_nested(self):
+        body = iter([b"streamed"])
+
+        def wsgi_app(environ, start_response):
+            start_response("200 OK", [("X-Path", environ['SCRIPT_NAME'] + "|" + environ['PATH_INFO'])])
+            return body
+
+        r = tinyaf.Router()
+        r.mount("/a/b", wsgi_app)
+        app = tinyaf.App(r)
+        resp = self.assertProducesResponse(app, "/a/b/c/d", 200, "streamed")
+        self.assertEqual("/a/b|/c/d", resp.headers_dict["X-Path"])
+        env = testbase.Request("/a/b").env
+        start = lambda status, headers: None
+        self.assertIs(body, app(env, start))  # the child's iterable is returned untouched
+        self.assertRaises(ValueError, app.mount, "/", wsgi_app)
+
+
+class BatchTest(testbase.TinyAppTestBase):
+    def batch(self, app, entries, code=200, **kwargs):
+        resp = self.assertProducesResponse(app, "/_batch", code, postdata=json.dumps(entries), **kwargs)
+        return resp.output_json() if code == 200 else resp
+
+    def make_app(self, **kwargs):
+        app = tinyaf.App()
+        app.route("/hello/<name>", handler=lambda req, resp: "hi " + req['name'])
+        app.route("/echo", methods=['POST'], handler=lambda req, resp: "%s|%s|%s|%s" % (
+            req.environ.get('CONTENT_TYPE'), req.headers['X-Token'], req.args.get('q'),
+            req.environ['wsgi.input'].read(int(req.environ['CONTENT_LENGTH'])).decode('utf-8')))
+        app.route("/raw", handler=lambda req, resp: tinyaf.Response([b"\xff\x00"]))
+        app.batch_endpoint("/_batch", max_requests=3, **kwargs)
+        return app
+
+    def test_batch(self):
+        app = self.make_app()
+        out = self.batch(app, [
+            {"path": "/hello/bob"},
+            {"method": "post", "path": "/echo?q=1", "body": {"a": 1}, "headers": {"X-Token": "mine"}},
+            {"path": "/raw"}], env={'HTTP_X_TOKEN': 'outer'})
+        self.assertEqual([200, 200, 200], [r['status'] for r in out])
+        self.assertEqual("hi bob", out[0]['body'])
+        self.assertIn(["content-length", "6"], out[0]['headers'])
+        self.assertEqual('application/json|mine|1|{"a": 1}', out[1]['body'])
+        self.assertEqual(("/wA=", "base64"), (out[2]['body'], out[2]['encoding']))
+        out = self.batch(app, [{"method": "POST", "path": "/echo", "body": "x"}, {"path": "/nope"},
+                               {"method": "GET", "path": "/echo"}], env={'HTTP_X_TOKEN': 'outer'})
+        self.assertEqual([200, 404, 405], [r['status'] for r in out])
+        self.assertEqual("None|outer|None|x", out[0]['body'])  # headers are inherited from the batch
+
+    def test_batch_parallel(self):
+        app = self.make_app(workers=4)
+        out = self.batch(app, [{"path": "/hello/%i" % i} for i in range(3)])
+        self.assertEqual(["hi 0", "hi 1", "hi 2"], [r['body'] for r in out])
+
+    def test_batch_nested(self):
+        app = self.make_app(workers=2)
+        nested = json.dumps([{"path": "/hello/x"}])
+        out = self.batch(app, [{"method": "POST", "path": "/_batch", "body": nested}] * 2)
+        self.assertEqual([400, 400], [r['status'] for r in out])
+        out = self.batch(app, [{"path": "/hello/%i" % i} for i in range(2)])
+        self.assertEqual(["hi 0", "hi 1"], [r['body'] for r in out])
+
+    def test_batch_under_deadline(self):
+        app = self.make_app(workers=2)
+        app.request_timeout, app.timeout_workers = 5, 1  # the batch itself holds the only deadline worker
+        app.route("/left", handler=lambda req, resp: "%.0f" % req.time_remaining())
+        out = self.batch(app, [{"path": "/hello/x"}, {"path": "/left"}])
+        self.assertEqual([200, 200], [r['status'] for r in out])
+        self.assertEqual("5", out[1]['body'])
+
+    def test_batch_bad_requests(self):
+        app = self.make_app()
+        self.batch(app, [{"path": "/hello/x"}] * 4, 413)
+        self.batch(app, {"path": "/hello/x"}, 400)
+        self.batch(app, [{"path": "hello/x"}], 400)
+        self.assertProducesResponse(app, "/_batch", 400, postdata="not json")
+        self.assertProducesResponse(app, "/_batch", 405)
+
+
+class WebSocketTest(testbase.TinyAppTestBase):
+    def setUp(self):
+        import threading
+        self.release = threading.Event()
+        self.app = app = tinyaf.App()
+
+        @app.websocket("/echo/<name>")
+        def echo(req, ws):
+            for message in ws:
+                ws.send(message if isinstance(message, bytes) else "%s: %s" % (req['name'], message))
+
+        @app.websocket("/one", max_sockets=1)
+        def one(req, ws):
+            self.release.wait(5)
+
+        @app.websocket("/small", max_size=10)
+        def small(req, ws):
+            ws.receive()
+        app.batch_endpoint("/_batch")
+        self.server = testbase.LiveServer(app)
+
+    def tearDown(self):
+        self.release.set()
+        self.server.stop()
+
+    def test_messages(self):
+        ws = testbase.WebSocketClient(self.server.port, "/echo/bob")
+        self.assertEqual(("101", "s3pPLMBiTxaQ9kYGzzhZRbK+xOo="), (ws.status, ws.headers['sec-websocket-accept']))
+        ws.send_frame(1, b"hi")
+        self.assertEqual((1, b"bob: hi"), ws.read_frame())
+        ws.send_frame(2, b"\x00" * 70000)
+        self.assertEqual((2, b"\x00" * 70000), ws.read_frame())
+        ws.send_frame(1, b"frag", fin=False)
+        ws.send_frame(9, b"p")  # control frames may come between fragments
+        ws.send_frame(0, b"men", fin=False)
+        ws.send_frame(0, b"ted")
+        self.assertEqual((10, b"p"), ws.read_frame())
+        self.assertEqual((1, b"bob: fragmented"), ws.read_frame())
+        ws.send_frame(8, b"\x03\xe8")
+        self.assertEqual((8, b"\x03\xe8"), ws.read_frame())
+        self.assertEqual(None, ws.read_frame())
+        ws.close()
+
+    def test_protocol_errors(self):
+        ws = testbase.WebSocketClient(self.server.port, "/echo/x")
+        ws.send_frame(0, b"no start")
+        self.assertEqual((8, b"\x03\xea"), ws.read_frame())  # 1002
+        ws.close()
+        ws = testbase.WebSocketClient(self.server.port, "/echo/x")
+        ws.send_frame(1, b"\xff")
+        self.assertEqual((8, b"\x03\xef"), ws.read_frame())  # 1007
+        ws.close()
+        ws = testbase.WebSocketClient(self.server.port, "/small")
+        ws.send_frame(1, b"x" * 11)
+        self.assertEqual((8, b"\x03\xf1"), ws.read_frame())  # 1009
+        ws.close()
+
+    def test_limits_and_plain_requests(self):
+        first = testbase.WebSocketClient(self.server.port, "/one")
+        self.assertEqual("101", first.status)
+        second = testbase.WebSocketClient(self.server.port, "/one")
+        self.assertEqual("503", second.status)
+        second.close()
+        self.release.set()
+        self.assertEqual(8, first.read_frame()[0])  # the handler returned, so the server closes
+        first.close()
+        self.assertProducesResponse(self.app, "/echo/x", 426)
+        self.assertProducesResponse(self.app, "/echo/x", 501, env={  # needs make_server's socket access
+            'HTTP_UPGRADE': 'websocket', 'HTTP_SEC_WEBSOCKET_VERSION': '13', 'HTTP_SEC_WEBSOCKET_KEY': 'x'})
+
+    def test_no_upgrade_from_batch(self):
+        import http.client
+        headers = {'Upgrade': 'websocket', 'Connection': 'Upgrade',
+                   'Sec-WebSocket-Version': '13', 'Sec-WebSocket-Key': 'dGhlIHNhbXBsZSBub25jZQ=='}
+        conn = http.client.HTTPConnection('127.0.0.1', self.server.port, timeout=5)
+        conn.request('POST', '/_batch', json.dumps([{"path": "/echo/x", "headers": headers}]))
+        resp = conn.getresponse()
+        self.assertEqual(200, resp.status)
+        self.assertEqual([501], [r['status'] for r in json.loads(resp.read().decode('utf-8'))])
+        conn.close()
+
+
+class AdmissionTest(testbase.TinyAppTestBase):
+    def start_blocked(self, app, url, count=1):
+        """Start requests that block in their handler until self.release is set."""
+        import threading
+        threads = [threading.Thread(target=testbase.Request(url).get_response, args=(app,))
+                   for _ in range(count)]
+        for t in threads: t.start()
+        return threads
+
+    def make_app(self, **kwargs):
+        import threading
+        self.entered, self.release = threading.Semaphore(0), threading.Event()
+        app = tinyaf.App()
+
+        @app.route("/slow", **kwargs)
+        def _(req, resp):
+            self.entered.release()
+            self.release.wait(5)
+            return "done"
+
+        app.route("/fast", handler=lambda req, resp: "fast")
+        return app
+
+    def test_reject_when_busy(self):
+        app = self.make_app(max_concurrency=1, retry_after=7)
+        threads = self.start_blocked(app, "/slow")
+        self.entered.acquire()
+        resp = self.assertProducesResponse(app, "/slow", 503)
+        self.assertEqual("7", resp.headers_dict["Retry-After"])
+        self.assertProducesResponse(app, "/fast", 200, "fast")  # other routes are unaffected
+        self.assertEqual({"/slow": dict(in_flight=1, queued=0, rejected=1)}, app.route_stats())
+        self.release.set()
+        for t in threads: t.join()
+        self.assertProducesResponse(app, "/slow", 200, "done")
+        self.assertEqual(dict(in_flight=0, queued=0, rejected=1), app.route_stats()["/slow"])
+
+    def test_queue(self):
+        import time
+        app = self.make_app(max_concurrency=1, queue=1, queue_timeout=0.05)
+        threads = self.start_blocked(app, "/slow")
+        self.entered.acquire()
+        start = time.time()
+        self.assertProducesResponse(app, "/slow", 503)  # waited in the queue, then timed out
+        self.assertGreaterEqual(time.time() - start, 0.04)
+        self.release.set()
+        for t in threads: t.join()
+        self.assertEqual(1, app.route_stats()["/slow"]["rejected"])
+
+
+class UploadTest(testbase.TinyAppTestBase):
+    def setUp(self):
+        self.app = app = tinyaf.App()
+        app.max_body_size = 100
+        app.route("/up", methods=['POST'], handler=lambda req, resp: "got %i" % (
+            len(req.environ['wsgi.input'].read(int(req.environ['CONTENT_LENGTH'])))))
+        app.route("/big", methods=['POST'], max_body=1000, handler=lambda req, resp: req.fields['a'])
+
+    def test_max_body(self):
+        import io
+        self.assertProducesResponse(self.app, "/up", 200, "got 100", postdata="x" * 100)
+        self.assertProducesResponse(self.app, "/big", 200, "y" * 500, postdata="a=" + "y" * 500)
+        body = io.BytesIO(b"x" * 101)
+        env = dict(testbase.Request("/up", postdata="x" * 101).env, **{'wsgi.input': body})
+        statuses = []
+        self.app(env, lambda status, headers: statuses.append(status))
+        self.assertEqual(("413", 0), (statuses[0][:3], body.tell()))  # rejected without reading a byte
+        self.assertProducesResponse(self.app, "/up", 400, method='POST', env={'CONTENT_LENGTH': 'lots'})
+
+    def expect_continue(self, server, path, body):
+        import socket
+        sock = socket.create_connection(('127.0.0.1', server.port), timeout=5)
+        sock.sendall(("POST %s HTTP/1.1\r\nHost: x\r\nContent-Length: %i\r\nExpect: 100-continue\r\n\r\n"
+                      % (path, len(body))).encode('ascii'))
+        rfile = sock.makefile('rb')
+        first = rfile.readline()
+        if b" 100 " in first:
+            rfile.readline()
+            sock.sendall(body)
+            first = rfile.readline()
+        reply = first + rfile.read()
+        rfile.close()
+        sock.close()
+        return reply
+
+    def test_expect_continue(self):
+        server = testbase.LiveServer(self.app)
+        try:
+            self.assertTrue(self.expect_continue(server, "/up", b"x" * 50).startswith(b"HTTP/1.0 200 OK"))
+            reply = self.expect_continue(server, "/up", b"x" * 500)
+            self.assertTrue(reply.startswith(b"HTTP/1.0 413"), reply)  # no 100 Continue came first
+            self.assertTrue(self.expect_continue(server, "/nope", b"x").startswith(b"HTTP/1.0 404"))
+        finally:
+            server.stop()
+
+
+class CoalesceTest(testbase.TinyAppTestBase):
+    def setUp(self):
+        import threading
+        self.calls, self.release = [], threading.Event()
+        self.app = app = tinyaf.App()
+
+        @app.route("/slow", coalesce=True, coalesce_headers=['Accept-Language'], coalesce_timeout=5)
+        def slow(req, resp):
+            self.calls.append(req.args.get('q'))
+            self.release.wait(5)
+            if req.args.get('q') == 'missing':
+                raise tinyaf.HttpError(404, headers={'X-Why': 'gone'})
+            resp.headers['X-Call'] = str(len(self.calls))
+            resp.headers['Set-Cookie'] = "token=%s" % (req.args.get('q'))
+            return "result %s" % (req.args.get('q'))
+
+        @app.route("/fast", coalesce=True, coalesce_timeout=0.05)
+        def fast(req, resp):
+            self.calls.append('fast')
+            self.release.wait(5)
+            return "fast"
+
+    def tearDown(self):
+        self.release.set()
+
+    def concurrent(self, urls, **kwargs):
+        """Start requests, the first alone; release the handler once the rest are waiting."""
+        import threading, time
+        results = [None] * len(urls)
+
+        def get(i):
+            results[i] = testbase.Request(urls[i], **kwargs).get_response(self.app)
+        threads = [threading.Thread(target=get, args=(i,)) for i in range(len(urls))]
+        threads[0].start()
+        while not self.calls:
+            time.sleep(0.001)
+        for t in threads[1:]: t.start()
+        time.sleep(0.1)
+        self.release.set()
+        for t in threads: t.join()
+        return results
+
+    def test_coalesce(self):
+        results = self.concurrent(["/slow?q=1"] * 5 + ["/slow?q=2"])
+        self.assertEqual(['1', '2'], sorted(self.calls))
+        self.assertEqual(["result 1"] * 5 + ["result 2"], [r.output_str() for r in results])
+        self.assertEqual(1, len(set(r.headers_dict['X-Call'] for r in results[:5])))
+        self.assertEqual("8", results[0].headers_dict['content-length'])
+        self.assertEqual(2, len([r for r in results if 'Set-Cookie' in r.headers_dict]))  # leaders only
+        self.assertProducesResponse(self.app, "/slow?q=1", 200, "result 1")  # nothing is cached
+        self.assertEqual(3, len(self.calls))
+
+    def test_coalesce_key_headers(self):
+        import threading, time
+
+        def get(lang):
+            testbase.Request("/slow?q=1", env={'HTTP_ACCEPT_LANGUAGE': lang}).get_response(self.app)
+        threads = [threading.Thread(target=get, args=(lang,)) for lang in ('en', 'fr', 'en')]
+        for t in threads: t.start()
+        end = time.time() + 2
+        while len(self.calls) < 2 and time.time() < end:  # en and fr don't wait for each other
+            time.sleep(0.001)
+        time.sleep(0.05)
+        self.release.set()
+        for t in threads: t.join()
+        self.assertEqual(2, len(self.calls))
+
+    def test_coalesce_key_method(self):
+        import threading, time
+        results = {}
+
+        def get(method):
+            results[method] = testbase.Request("/slow?q=1", method=method).get_response(self.app)
+        threads = [threading.Thread(target=get, args=(method,)) for method in ('HEAD', 'GET')]
+        for t in threads: t.start()
+        end = time.time() + 2
+        while len(self.calls) < 2 and time.time() < end:  # a GET doesn't wait for a HEAD
+            time.sleep(0.001)
+        self.release.set()
+        for t in threads: t.join()
+        self.assertEqual(2, len(self.calls))
+        self.assertEqual(("", "result 1"), (results['HEAD'].output_str(), results['GET'].output_str()))
+
+    def test_coalesce_errors(self):
+        results = self.concurrent(["/slow?q=missing"] * 3)
+        self.assertEqual([404] * 3, [r.code for r in results])
+        self.assertEqual(['gone'] * 3, [r.headers_dict['X-Why'] for r in results])
+        self.assertEqual(1, len(self.calls))
+        self.release.clear()
+        del self.calls[:]
+        results = self.concurrent(["/fast"] * 2)  # the follower gives up after 0.05s
+        self.assertEqual([200, 504], [r.code for r in results])
+        self.assertEqual(1, self.app.timeouts)
+
+
+def process_handler(req, resp):  # module-level, so worker processes can find it by name
+    import os, time
+    if req['name'] == 'missing':
+        raise tinyaf.HttpError(404, headers={'X-Why': 'gone'})
+    if req['name'] == 'crash':
+        raise ValueError("bad input")
+    if req['name'] == 'slow':
+        time.sleep(0.3)
+    if req['name'] == 'defer':
+        resp.defer(record_deferred, os.getpid())
+    return tinyaf.JsonResponse(dict(name=req['name'], pid=os.getpid(), fields=req.fields,
+                                    thing=req.headers.get('X-Thing'), extra=req.vars.get('extra')))
+
+
+deferred_calls = []
+
+
+def record_deferred(worker_pid):
+    import os, time
+    time.sleep(0.2)
+    deferred_calls.append((worker_pid, os.getpid()))
+
+
+class ProcessExecutorTest(testbase.TinyAppTestBase):
+    def setUp(self):
+        self.app = app = tinyaf.App()
+        app.process_workers = 2
+        app.tracebacks_to_stderr = False
+        app.tracebacks_to_http = True
+        app.route("/p/<name>", executor='process', timeout=5, vars={'extra': 'x'}, handler=process_handler)
+        app.route("/timed/<name>", executor='process', timeout=0.1, handler=process_handler)
+
+    def tearDown(self):
+        self.app.shutdown()
+
+    def test_process_executor(self):
+        import os
+        out = self.assertProducesJson(self.app, "/p/bob?a=1", dict(name="bob", fields={'a': '1'}, thing="yes",
+                                                                  extra="x"), fuzzy=True,
+                                      env={'HTTP_X_THING': 'yes'}).output_json()
+        self.assertNotEqual(os.getpid(), out['pid'])
+        out = self.assertProducesResponse(self.app, "/p/amy", 200, postdata="b=2&b=3").output_json()
+        self.assertEqual({'b': ['2', '3']}, out['fields'])
+
+    def test_process_errors(self):
+        resp = self.assertProducesResponse(self.app, "/p/missing", 404)
+        self.assertEqual("gone", resp.headers_dict['X-Why'])
+        resp = self.assertProducesResponse(self.app, "/p/crash", 500)
+        self.assertIn("ValueError: bad input", resp.output_str())  # the worker's traceback
+        self.assertProducesResponse(self.app, "/timed/slow", 504)
+        self.assertRaises(ValueError, self.app.route, "/lambda", executor='process',
+                          handler=lambda req, resp: "can't be pickled")
+        self.assertRaises(ValueError, self.app.route, "/other", executor='fiber', handler=process_handler)
+
+    def test_process_defer(self):
+        import os
+        self.assertProducesResponse(self.app, "/p/defer", 200)
+        self.assertEqual([], deferred_calls)  # queued, not run before the response was returned
+        self.app.shutdown()
+        worker_pid, pid = deferred_calls.pop()
+        self.assertEqual(os.getpid(), pid)
+        self.assertNotEqual(pid, worker_pid)
+
+
+class DeadlineTest(testbase.TinyAppTestBase):
+    def test_route_timeout(self):
+        import threading
+        release = threading.Event()
+        app = tinyaf.App()
+        app.route("/stuck", timeout=0.05, handler=lambda req, resp: release.wait(5) and "late")
+        app.route("/quick", timeout=5, handler=lambda req, resp: "%.0f" % req.time_remaining())
+        app.route("/none", handler=lambda req, resp: str(req.time_remaining()))
+        app.errorhandler(504, handler=lambda req, resp: "gave up")
+        self.assertProducesResponse(app, "/stuck", 504, "gave up")
+        self.assertEqual(1, app.timeouts)
+        release.set()
+        self.assertProducesResponse(app, "/quick", 200, "5")
+        self.assertProducesResponse(app, "/none", 200, "None")
+        self.assertEqual(1, app.timeouts)
+
+    def test_app_timeout(self):
+        app = tinyaf.App()
+        app.request_timeout = 0
+        app.route("/", handler=lambda req, resp: __import__('time').sleep(0.05))
+        app.route("/override", timeout=None, handler=lambda req, resp: "OK")
+        self.assertProducesResponse(app, "/", 504)
+        self.assertProducesResponse(app, "/override", 200, "OK")
+
+    def test_queued_handler_skipped(self):
+        import threading, time
+        release, effects = threading.Event(), []
+        app = tinyaf.App()
+        app.timeout_workers, app.timeout_queue = 1, 1
+        app.route("/stuck", timeout=0.05, handler=lambda req, resp: release.wait(5) and "late")
+        app.route("/write", methods=['POST'], timeout=0.05, handler=lambda req, resp: effects.append(1))
+        self.assertProducesResponse(app, "/stuck", 504)
+        self.assertProducesResponse(app, "/write", 504, postdata="x")  # queued behind /stuck
+        self.assertProducesResponse(app, "/write", 503, postdata="x")  # the queue is full
+        release.set()
+        time.sleep(0.1)
+        self.assertEqual([], effects)
+        self.assertEqual(2, app.timeouts)
+
+    def test_errors_propagate(self):
+        app = tinyaf.App()
+        app.tracebacks_to_stderr = False
+
+        @app.route("/", timeout=5)
+        def _(req, resp):
+            raise tinyaf.HttpError(418)
+
+        @app.route("/boom", timeout=5)
+        def _(req, resp):
+            raise ValueError("boom")
+
+        self.assertProducesResponse(app, "/", 418)
+        self.assertProducesResponse(app, "/boom", 500)
+
+
+class SharedCacheTest(testbase.TinyAppTestBase):
+    def setUp(self):
+        import os
+        self.name = "tinyaf-test-%i" % (os.getpid())
+        self.cache = tinyaf.SharedCache(self.name, slots=16, slot_size=128, ways=4)
+
+    def tearDown(self):
+        self.cache.close()
+        self.cache.unlink()
+
+    def test_get_set(self):
+        import time
+        cache = self.cache
+        self.assertEqual(None, cache.get("a"))
+        self.assertTrue(cache.set("a", b"1"))
+        self.assertTrue(cache.set(b"b", b"2", ttl=0.05))
+        self.assertEqual((b"1", b"2"), (cache.get(b"a"), cache.get("b")))
+        self.assertTrue(cache.set("a", b"one"))
+        self.assertEqual(b"one", cache.get("a"))
+        cache.delete("a")
+        self.assertEqual("gone", cache.get("a", "gone"))
+        self.assertFalse(cache.set("big", b"x" * 100))
+        time.sleep(0.1)
+        self.assertEqual(None, cache.get("b"))
+        self.assertEqual(dict(hits=3, misses=3, sets=3, evictions=0, rejected=1), cache.stats())
+
+    def test_eviction(self):
+        cache = self.cache
+        for i in range(64):  # four times what fits
+            cache.set("k%i" % i, b"v%i" % i)
+            cache.get("k0")  # keep one key hot
+        self.assertEqual(b"v0", cache.get("k0"))
+        self.assertEqual(b"v63", cache.get("k63"))
+        self.assertGreaterEqual(cache.stats()['evictions'], 48)
+        self.assertEqual(16, sum(1 for i in range(64) if cache.get("k%i" % i) is not None))
+
+    def test_across_processes(self):
+        import subprocess, sys
+        code = ("import tinyaf; c = tinyaf.SharedCache(%r, slots=16, slot_size=128, ways=4); "
+                "print(c.get('from parent').decode()); c.set('from child', b'hello'); c.close()" % (self.name))
+        self.cache.set("from parent", b"hi")
+        out = subprocess.check_output([sys.executable, "-c", code], universal_newlines=True)
+        self.assertEqual("hi", out.strip())
+        self.assertEqual(b"hello", self.cache.get("from child"))
+        self.assertRaises(ValueError, tinyaf.SharedCache, self.name, slots=32, slot_size=128, ways=4)
+
+
+class AccessLogTest(testbase.TinyAppTestBase):
+    def make_app(self, **kwargs):
+        import io
+        app = tinyaf.App()
+        app.tracebacks_to_stderr = False
+        app.access_log = tinyaf.AccessLog(kwargs.pop('target', None) or io.StringIO(), **kwargs)
+        app.route("/hello/<name>", handler=lambda req, resp: "hi " + req['name'])
+        app.route("/boom", handler=lambda req, resp: 1 / 0)
+        return app
+
+    def test_access_log(self):
+        app = self.make_app()
+        self.assertProducesResponse(app, "/hello/bob?x=1", 200, "hi bob")
+        self.assertProducesResponse(app, "/nope", 404)
+        self.assertTrue(app.shutdown(5))
+        lines = app.access_log.stream.getvalue().splitlines()
+        self.assertTrue(re.match(r'^127\.0\.0\.1 - - \[.*\] "GET /hello/bob\?x=1 HTTP/1\.1" '
+                                 r'200 6 [0-9.]+ /hello/<name>$', lines[0]), lines[0])
+        self.assertTrue(re.search(r'"GET /nope HTTP/1\.1" 404 \d+ [0-9.]+ -$', lines[1]), lines[1])
+
+    def test_mounted_app(self):
+        app, child = self.make_app(), tinyaf.App()
+        child.route("/x", handler=lambda req, resp: "child")
+        app.mount("/c", child)
+        self.assertProducesResponse(app, "/c/x", 200, "child")
+        self.assertProducesResponse(app, "/hello/y", 200, "hi y")
+        self.assertTrue(app.shutdown(5))
+        lines = app.access_log.stream.getvalue().splitlines()
+        self.assertTrue(re.search(r'"GET /c/x HTTP/1\.1" 200 5 [0-9.]+ -$', lines[0]), lines[0])
+        self.assertIn("/hello/y", lines[1])
+
+    def test_json_lines_and_tracebacks(self):
+        app = self.make_app(json_lines=True)
+        self.assertProducesResponse(app, "/boom", 500)
+        app.shutdown(5)
+        self.assertNotIn("ZeroDivisionError", app.access_log.stream.getvalue())  # tracebacks_to_stderr is off
+        app = self.make_app(json_lines=True)
+        app.tracebacks_to_stderr = True
+        self.assertProducesResponse(app, "/boom", 500)
+        app.shutdown(5)
+        output = app.access_log.stream.getvalue()
+        self.assertIn("ZeroDivisionError", output)  # the traceback went to the log, formatted there
+        record = json.loads(output.splitlines()[-1])
+        self.assertEqual(("GET", "/boom", "/boom", 500), (record['method'], record['path'], record['route'],
+                                                          record['status']))
+
+    def test_overload_drops(self):
+        import io, threading
+        release = threading.Event()
+
+        class SlowStream(io.StringIO):
+            def write(self, text):
+                release.wait(5)
+                return io.StringIO.write(self, text)
+        app = self.make_app(target=SlowStream(), queue_size=2)
+        for _ in range(10):  # the writer is stuck, so these can't all fit; none of them may block
+            self.assertProducesResponse(app, "/hello/x", 200)
+        self.assertGreater(app.access_log.dropped, 0)
+        release.set()
+        self.assertTrue(app.shutdown(5))
+        app.access_log.log(tinyaf.Request(testbase.Request("/").env), 200, 0, 0)  # one more to report drops
+        app.access_log.flush(5)
+        self.assertIn("records dropped", app.access_log.stream.getvalue())
+
+
+class DeferTest(testbase.TinyAppTestBase):
+    def test_defer_after_close(self):
+        import threading
+        log, done = [], threading.Event()
+        app = tinyaf.App()
+
+        @app.route("/")
+        def _(req, resp):
+            resp.defer(log.append, "deferred")
+            resp.defer(done.set)
+            log.append("handler")
+            return "OK"
+
+        out = app(testbase.Request("/")._environ(), lambda status, headers: None)
+        log.append("".join(x.decode('utf-8') for x in out))
+        self.assertFalse(done.wait(0.05))  # nothing runs until the server closes the iterable
+        out.close()
+        self.assertTrue(done.wait(5))
+        self.assertEqual(["handler", "OK", "deferred"], log)
+
+    def test_defer_on_error(self):
+        import threading
+        done = threading.Event()
+        app = tinyaf.App()
+
+        @app.route("/")
+        def _(req, resp):
+            err = tinyaf.HttpError(403)
+            err.defer(done.set)
+            raise err
+
+        self.assertProducesResponse(app, "/", 403)
+        self.assertTrue(done.wait(5))
+
+    def test_defer_then_replace(self):
+        log = []
+        app = tinyaf.App()
+
+        @app.route("/json")
+        def _(req, resp):
+            resp.defer(log.append, "json")
+            out = tinyaf.JsonResponse({"ok": True})
+            out.defer(log.append, "json, own")
+            return out
+
+        @app.route("/error")
+        def _(req, resp):
+            resp.defer(log.append, "error")
+            raise tinyaf.HttpError(404)
+
+        self.assertProducesJson(app, "/json", {"ok": True})
+        self.assertProducesResponse(app, "/error", 404)
+        self.assertTrue(app.shutdown(5))
+        self.assertEqual(["error", "json", "json, own"], sorted(log))  # the pool runs them in any order
+
+    def test_failures_and_overflow(self):
+        import io
+        import sys
+        import threading
+        release, ran = threading.Event(), []
+        app = tinyaf.App()
+        app.background_workers, app.background_queue = 1, 1
+
+        @app.route("/")
+        def _(req, resp):
+            resp.defer(release.wait, 5)  # occupies the only worker
+            resp.defer(ran.append, 1)  # fills the queue
+            resp.defer(ran.append, 2)  # overflows
+
+        @app.route("/more")
+        def _(req, resp):
+            resp.defer(ran.append, 3)
+            resp.defer(lambda: 1 / 0)
+
+        stderr, sys.stderr = sys.stderr, io.StringIO()
+        try:
+            self.assertProducesResponse(app, "/", 200)
+            app.background_overflow = 'inline'
+            self.assertProducesResponse(app, "/more", 200)
+            self.assertEqual([3], ran)  # ran during close(), since the queue was still full
+            release.set()
+            self.assertTrue(app.shutdown(5))
+            log = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertIn("dropped deferred call", log)
+        self.assertIn("ZeroDivisionError", log)
+        self.assertEqual([3, 1], ran)
+
+
+class TemplateTest(testbase.TinyAppTestBase):
+    SOURCES = {
+        'page.html': "<h1>{{ title }}</h1>{# comment #}\n"
+                     "{% for n in items %}{% if n > 1 %}<b>{{ n }}</b>{% elif n %}one"
+                     "{% else %}none{% endif %}{% endfor %}{{! raw }}{% include 'footer.html' %}",
+        'footer.html': "<p>{{ title }}</p>",
+    }
+
+    def test_render(self):
+        templates = tinyaf.Templates(sources=self.SOURCES)
+        out = templates.render('page.html', dict(title="<Hi & bye>", items=[0, 1, 2], raw="<i>"))
+        self.assertEqual("<h1>&lt;Hi &amp; bye&gt;</h1>\nnoneone<b>2</b><i><p>&lt;Hi &amp; bye&gt;</p>",
+                         out)
+        self.assertRaises(SyntaxError, templates.compile, "{% for x in y %}")
+        self.assertRaises(SyntaxError, templates.compile, "{% endif %}")
+
+    def test_response_streams(self):
+        templates = tinyaf.Templates(sources={'list': "{% for i in range(n) %}{{ i }},{% endfor %}"})
+        app = tinyaf.App()
+        app.route("/", handler=lambda req, resp: tinyaf.TemplateResponse(
+            'list', {'n': 5000}, templates=templates))
+        resp = self.assertProducesResponse(app, "/", 200)
+        self.assertGreater(len(resp.output_list), 1)  # sent in chunks, not one big string
+        self.assertTrue(resp.output_str().startswith("0,1,2,"))
+        self.assertEqual("text/html; charset=utf-8", resp.headers_dict['content-type'])
+
+    def test_missing_template(self):
+        app = tinyaf.App()
+        app.tracebacks_to_stderr = False
+        app.route("/", handler=lambda req, resp: tinyaf.TemplateResponse(
+            'nope.html', templates=tinyaf.Templates(directory='/nonexistent')))
+        self.assertProducesResponse(app, "/", 500)
+
+    def test_reload_and_cache(self):
+        import os
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 't.html')
+            with open(path, 'w') as f: f.write("v1 {{ x }}")
+            os.utime(path, (1000, 1000))
+            templates = tinyaf.Templates(directory, cache_size=1)
+            self.assertEqual("v1 1", templates.render('t.html', {'x': 1}))
+            code = templates.get('t.html')
+            self.assertIs(code, templates.get('t.html'))  # unchanged file: no recompile
+            with open(path, 'w') as f: f.write("v2 {{ x }}")
+            os.utime(path, (2000, 2000))
+            self.assertEqual("v2 1", templates.render('t.html', {'x': 1}))
+            templates.sources['other'] = "o"
+            templates.render('other')
+            self.assertEqual(['other'], list(templates.cache))  # LRU evicted t.html
+        finally:
+            shutil.rmtree(directory)
+
+
+class StaticArchiveTest(testbase.TinyAppTestBase):
+    def setUp(self):
+        import gzip
+        import os
+        import tempfile
+        import zipfile
+        fd, self.path = tempfile.mkstemp(suffix='.pyz')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b"#!/usr/bin/env python\nprint('a script with a zip appended')\n")
+            with zipfile.ZipFile(f, 'w', zipfile.ZIP_STORED) as z:
+                z.writestr('index.html', "<h1>home</h1>")
+                z.writestr('css/site.css', "body {}" * 100000)
+                z.writestr('app.js', "var x = 1;")
+                z.writestr('app.js.gz', gzip.compress(b"var x = 1;"))
+                z.writestr('deflated.txt', "squeezed " * 10, compress_type=zipfile.ZIP_DEFLATED)
+        self.app = tinyaf.App()
+        self.archive = self.app.static_archive("/static/", self.path)
+
+    def tearDown(self):
+        import os
+        self.archive.map.close()
+        os.remove(self.path)
+
+    def test_serve(self):
+        resp = self.assertProducesResponse(self.app, "/static/", 200, "<h1>home</h1>")
+        self.assertEqual("text/html", resp.headers_dict['content-type'])
+        resp = self.assertProducesResponse(self.app, "/static/css/site.css", 200, "body {}" * 100000)
+        self.assertGreater(len(resp.output_list), 1)
+        self.assertEqual("700000", resp.headers_dict['content-length'])
+        self.assertProducesResponse(self.app, "/static/deflated.txt", 200, "squeezed " * 10)
+        self.assertProducesResponse(self.app, "/static/nope.txt", 404)
+        self.assertProducesResponse(self.app, "/static/app.js", 405, postdata="x")
+
+    def test_etag_and_gzip(self):
+        import gzip
+        resp = self.assertProducesResponse(self.app, "/static/app.js", 200, "var x = 1;")
+        etag = resp.headers_dict['etag']
+        self.assertEqual("Accept-Encoding", resp.headers_dict['Vary'])
+        resp = self.assertProducesResponse(self.app, "/static/app.js", 304, "",
+                                           env=dict(HTTP_IF_NONE_MATCH=etag))
+        resp = self.assertProducesResponse(self.app, "/static/app.js", 200,
+                                           env=dict(HTTP_ACCEPT_ENCODING="gzip, br"))
+        self.assertEqual("gzip", resp.headers_dict['Content-Encoding'])
+        self.assertEqual("application/javascript", resp.headers_dict['content-type'].replace(
+            "text/javascript", "application/javascript"))
+        self.assertEqual(b"var x = 1;", gzip.decompress(resp.output()))
+        resp = self.assertProducesResponse(self.app, "/static/app.js.gz", 200)  # asked for by name
+        self.assertEqual("gzip", resp.headers_dict['Content-Encoding'])
+        self.assertEqual(b"var x = 1;", gzip.decompress(resp.output()))
+
+
+class SessionTest(testbase.TinyAppTestBase):
+    class CountingStore(tinyaf.MemorySessionStore):
+        calls = 0
+
+        def load(self, sid):
+            self.calls += 1
+            return tinyaf.MemorySessionStore.load(self, sid)
+
+        def save(self, sid, data):
+            self.calls += 1
+            return tinyaf.MemorySessionStore.save(self, sid, data)
+
+    def make_app(self, store):
+        app = tinyaf.App()
+        app.sessions = tinyaf.Sessions("s3cret", store=store)
+
+        @app.route("/inc")
+        def _(req, resp):
+            req.session['n'] = req.session.get('n', 0) + 1
+            return str(req.session['n'])
+
+        app.route("/peek", handler=lambda req, resp: str(req.session.get('n')))
+        app.route("/none", handler=lambda req, resp: "untouched")
+
+        @app.route("/logout")
+        def _(req, resp):
+            req.session.clear()
+
+        return app
+
+    def cookie(self, resp):
+        return resp.headers_dict['Set-Cookie'].split(';')[0]
+
+    def test_session_roundtrip(self):
+        store = self.CountingStore()
+        app = self.make_app(store)
+        resp = self.assertProducesResponse(app, "/inc", 200, "1")
+        env = dict(HTTP_COOKIE="other=1; " + self.cookie(resp))
+        resp = self.assertProducesResponse(app, "/inc", 200, "2", env=env)
+        self.assertNotIn('Set-Cookie', resp.headers_dict)  # existing session: no new cookie
+        calls = store.calls
+        resp = self.assertProducesResponse(app, "/none", 200, "untouched", env=env)
+        self.assertEqual(calls, store.calls)  # routes that ignore the session never hit the store
+        self.assertProducesResponse(app, "/peek", 200, "2", env=env)
+        self.assertEqual(calls + 1, store.calls)  # read-only access loads but doesn't write
+        resp = self.assertProducesResponse(app, "/logout", 200, env=env)
+        self.assertIn('Max-Age=0', resp.headers_dict['Set-Cookie'])
+        self.assertProducesResponse(app, "/peek", 200, "None", env=env)
+
+    def test_tampered_cookie(self):
+        app = self.make_app(tinyaf.MemorySessionStore())
+        sid, sig = self.cookie(self.assertProducesResponse(app, "/inc", 200, "1")).split('.')
+        self.assertProducesResponse(app, "/peek", 200, "None", env=dict(HTTP_COOKIE=sid + ".x" + sig))
+        self.assertProducesResponse(app, "/peek", 200, "None", env=dict(HTTP_COOKIE=sid))
+        name = sid.split('=')[0]
+        for value in ("abc.d\xe9f", "\xe9." + sig):  # non-ASCII is just another bad signature
+            self.assertProducesResponse(app, "/peek", 200, "None", env=dict(HTTP_COOKIE=name + "=" + value))
+
+    def test_memory_store_eviction(self):
+        store = tinyaf.MemorySessionStore(max_entries=2, ttl=60)
+        store.save('a', {'v': 1})
+        store.save('b', {'v': 2})
+        store.load('a')  # 'b' is now least recently used
+        store.save('c', {'v': 3})
+        self.assertEqual((True, False, True), tuple(store.load(k) is not None for k in 'abc'))
+        store.ttl = -1
+        store.save('d', {'v': 4})
+        self.assertIsNone(store.load('d'))
+
+    def test_sqlite_store(self):
+        import os
+        import tempfile
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        try:
+            app = self.make_app(tinyaf.SqliteSessionStore(path))
+            env = dict(HTTP_COOKIE=self.cookie(self.assertProducesResponse(app, "/inc", 200, "1")))
+            other = self.make_app(tinyaf.SqliteSessionStore(path))  # e.g. another process
+            self.assertProducesResponse(other, "/inc", 200, "2", env=env)
+            self.assertProducesResponse(app, "/peek", 200, "2", env=env)
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix): os.remove(path + suffix)
+
+    def test_sessions_disabled(self):
+        app = tinyaf.App()
+        app.tracebacks_to_stderr = False
+        app.route("/", handler=lambda req, resp: str(req.session))
+        self.assertProducesResponse(app, "/", 500)
+
 
 class JsonTest(testbase.TinyAppTestBase):
     def test_json_details(self):
@@ -337,6 +1472,23 @@ class JsonTest(testbase.TinyAppTestBase):
         self.assertProducesJson(app, "/", {"hello": "world"})
 
 
+class ImportTest(testbase.TinyAppTestBase):
+    LAZY_MODULES = ('cgi', 'json', 'mimetypes', 'traceback', 'socketserver',
+                    'wsgiref.simple_server', 'tinyaf._tinyaf_doc')
+
+    def test_import_is_lazy(self):
+        """Importing tinyaf must not pull in modules only some apps need."""
+        code = "import sys, tinyaf; print(' '.join(m for m in %r if m in sys.modules))" % (
+            self.LAZY_MODULES,)
+        out, times = testbase.import_time(code)
+        self.assertEqual("", out.strip())
+        self.assertIn('tinyaf', times)
+
+    def test_docs_for_interactive(self):
+        out, _ = testbase.import_time("import pydoc, tinyaf; print(tinyaf.Router.route.__doc__ is None)")
+        self.assertEqual("False", out.strip())
+
+
 # TODO:
 # * specific details of request forwarding,
 # * json response,
@@ -0,0 +1,54 @@
+"""Tests that need `async def`, kept apart so tests.py still imports on Python 2."""
+from __future__ import absolute_import
+
+from . import testbase
+import tinyaf
+
+
+class AsyncTest(testbase.TinyAppTestBase):
+    def test_async_handlers(self):
+        import asyncio
+        import threading
+        app = tinyaf.App()
+
+        @app.route("/")
+        async def _(req, resp):
+            await asyncio.sleep(0)
+            return threading.current_thread().name
+
+        @app.route("/json")
+        async def _(req, resp):
+            return tinyaf.JsonResponse({"async": True})
+
+        @app.route("/missing")
+        async def _(req, resp):
+            raise tinyaf.HttpError(404)
+
+        @app.errorhandler(404)
+        async def _(req, err):
+            return "async 404"
+
+        self.assertProducesResponse(app, "/", 200, "tinyaf-asyncio")
+        self.assertProducesJson(app, "/json", {"async": True})
+        self.assertProducesResponse(app, "/missing", 404, "async 404")
+        self.assertProducesResponse(app, "/nope", 404, "async 404")
+
+    def test_async_timeout_cancels(self):
+        import asyncio
+        app = tinyaf.App()
+        cancelled = []
+
+        @app.route("/", timeout=0.05)
+        async def _(req, resp):
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        self.assertProducesResponse(app, "/", 504)
+        self.assertEqual(1, app.timeouts)
+        for _ in range(100):
+            if cancelled: break
+            __import__('time').sleep(0.01)
+        self.assertEqual([True], cancelled)
@@ -18,26 +18,21 @@ comprehensive frameworks like Flask, Django, or Bottle.
   This is precisely as minimal an app framework as reasonably tolerable.
 """
 
-from . import _tinyaf_doc
 from . import tinyaf as _tinyaf
-from .tinyaf import *  # this is redundant, but placates some static analyzers.
+from .tinyaf import *  # noqa: F401,F403
+from .tinyaf import __all__
 
-import types
 import sys
 
-# The __init__ module transparently exports the tinyaf.py module, except that it
-# also transparently swaps in the docstrings from _tinyaf_doc.py, so that if you
-# import tinyaf (rather than tinyaf.tinyaf) into Python, then you'll end up with
-# the full docs in your help text and whatnot.
-
-# This was a good idea a the time, back when tools actually imported your Python
-# code instead of just parsing it. Now it's not a terrifically useful concept
-# and just causes headaches. This technique will soon be replaced.
-
-# Copy all the docstrings from tinyaf_doc into tinyaf
+# The __init__ module transparently exports the tinyaf.py module. The long-form
+# docstrings live in _tinyaf_doc.py; copying them over means importing that
+# module and walking every class, which is wasted work for servers, CGI scripts
+# and short-lived CLI invocations that never ask for help text. So we only do it
+# when someone is in a position to read them: an interactive session or pydoc.
 
 
 def _copy_docs(a, b):
+    import types
     for name in (x for x in dir(a) if x[0] != "_"):
         try:
             a1, b1 = getattr(a, name), getattr(b, name)
@@ -52,20 +47,16 @@ def _copy_docs(a, b):
                     pass
             _copy_docs(a1, b1)
 
-# Essentially, `from .tinyaf import *` and set __all__ accordingly.
-
 
-def _exportall(from_mod, to_mod):
-    """Copy the target namespace into the current one."""
-    to_mod.__all__ = []
-    for k in dir(from_mod):
-        if not k.startswith('_'):
-            setattr(to_mod, k, getattr(from_mod, k))
-            to_mod.__all__.append(k)
+def _wants_docs():
+    main_spec = getattr(sys.modules.get('__main__'), '__spec__', None)
+    return (hasattr(sys, 'ps1') or sys.flags.interactive or 'pydoc' in sys.modules
+            or getattr(main_spec, 'name', None) == 'pydoc')
 
 
-_copy_docs(_tinyaf_doc, _tinyaf)
-_exportall(_tinyaf, sys.modules[__name__])
-# Done with these; remove so that people don't think tinyaf._tinyaf.App is a thing.
+if _wants_docs():
+    from . import _tinyaf_doc
+    _copy_docs(_tinyaf_doc, _tinyaf)
+    del _tinyaf_doc
+# Done with this; remove so that people don't think tinyaf._tinyaf.App is a thing.
 del _tinyaf
-del _tinyaf_doc
@@ -41,6 +41,12 @@ class Router(object):
         returns a new Response object, then the provided one will be discarded.
         Otherwise any content you return will be appended using response.write(...)
 
+        Handlers (and error handlers) may also be `async def` coroutines. They
+        run on a single asyncio event loop thread shared by the whole process,
+        so they can share async connection pools; the request thread waits for
+        the result. With a `timeout`, an async handler that overruns is
+        cancelled and the request gets a 504.
+
         Args:
             path: str
                 The URL to map the handler to. The pattern is described below.
@@ -50,12 +56,81 @@ class Router(object):
             methods: list(string)
                 An optional list of HTTP methods to associate with this mapping.
                 If present, the mapping will *only* service matching HTTP methods.
+                A route that takes GET also takes HEAD. For a HEAD request the
+                handler runs as usual and its headers (Content-Length
+                included) are sent, but the body is never produced or sent.
+                An OPTIONS request to a path whose routes don't take OPTIONS
+                is answered with a 204 and an Allow header, without calling
+                any handler.
             response_class: type(Response)
                 A class derived from Response that will be provided as the "default"
                 response to the handler.
             vars: dict(string: string)
                 A set of key-value pairs to be set in the Request object passed
                 to the handler.
+            max_concurrency: int
+                If set, at most this many calls to the handler run at once.
+                Requests beyond that are rejected with an HttpError(503) with a
+                Retry-After header, before any handler work is done.
+            queue: int
+                With max_concurrency, how many more requests may wait for a
+                free slot instead of being rejected (default 0).
+            queue_timeout: float
+                How many seconds a queued request waits before it's rejected
+                (default: no limit).
+            retry_after: int
+                Seconds to send in the Retry-After header of rejections (default 1).
+            coalesce: bool
+                If true, concurrent GET (or HEAD) requests with the same method,
+                path and query string share one run of the handler: the first runs
+                it, and the others wait for it and get a copy of its finished
+                response (status, headers and body, less any Set-Cookie
+                headers, which only the first request gets). Nothing is kept once
+                that run is over; it's not a cache. If the handler raises, the
+                waiting requests get an HttpError with the same code and
+                headers (a 500 for other exceptions, whose traceback is
+                reported once). Don't coalesce responses that differ per user
+                unless the headers that make them differ are in
+                coalesce_headers.
+            coalesce_headers: list(string)
+                Request headers that are also part of the coalescing key,
+                such as "Accept-Language" or "Cookie".
+            coalesce_timeout: float
+                Seconds a waiting request waits before giving up with a 504
+                (default 30, or the request's deadline if it has one). These
+                504s are counted in App.timeouts.
+            executor: 'process'
+                Run the handler in a separate process (from a pool of
+                App.process_workers), so CPU-bound work doesn't hold the GIL
+                while other requests are handled. The handler must be a
+                module-level function. Lambdas and closures are rejected with a
+                ValueError when the route is registered.
+
+                The worker receives a rebuilt Request. It has the original
+                path, method, vars, headers, query string and body, so
+                fields and args work as usual. It has no app, so there's no
+                session. Its Response is finalized and read in the worker,
+                and the status, headers and body bytes are sent back.
+                Deferred calls are sent back with it and run in this
+                process's background pool, like any others; calls that can't
+                be pickled run on a thread in the worker instead.
+
+                An HttpError from the handler is raised again with the same
+                code and headers. Any other exception becomes a 500, carrying
+                the worker's traceback. With a timeout, a handler that
+                overruns gets a 504. The call itself can't be stopped, and
+                it finishes in the worker.
+            max_body: int
+                Largest request body, in bytes, overriding App.max_body_size.
+                A request whose Content-Length is bigger gets a 413 before
+                the handler runs, and before anything reads the body.
+            timeout: float
+                Seconds the handler has to produce its response, overriding
+                App.request_timeout (pass None to disable it for this route).
+                With a timeout, the handler runs on a worker thread; if it
+                hasn't returned by the deadline, the request gets an
+                HttpError(504) through the usual error handlers, and the
+                handler is left to finish (or not) in the background.
 
         There are two kinds of patterns for URLs, "standard" patterns, and
         regex patterns. If the pattern does not start with a "^", then it's treated
@@ -150,9 +225,103 @@ class Router(object):
         will be appended using error.write(...).
         """
 
+    def mount(self, prefix, application):
+        """Hand every URL under `prefix` to another WSGI application.
+
+        Mounts are resolved before any route is considered, by looking up
+        successively shorter prefixes of the path in a dict. A mount at "/api"
+        receives "/api" and "/api/anything", but not "/apix". The matched
+        prefix is moved from PATH_INFO to the end of SCRIPT_NAME in the
+        original environ (no copy is made), and the child's return value is
+        passed straight back to the server without being buffered or wrapped.
+
+        The application can be another App or any WSGI callable. Returns the
+        application.
+        """
+
+    def static_archive(self, prefix, archive, index='index.html'):
+        """Serve the files in a zip archive under a URL prefix.
+
+        `archive` is a path to a zip file, or to any file with a zip appended
+        (such as a script you ship as one file), or a StaticArchive. GET and
+        HEAD requests for "<prefix>/<member name>" are answered from the
+        archive; a name ending in "/" gets its `index` member.
+
+        Returns the StaticArchive.
+        """
+
+    def websocket(self, path, handler=None, max_sockets=100, max_size=2 ** 20, idle_timeout=None,
+                  vars=None):
+        """Register a WebSocket handler for a URL path (a decorator if no handler).
+
+        The path uses the same syntax as route(). The handler is called as
+        handler(request, websocket) once the connection has been upgraded,
+        and the connection is closed when it returns. Upgrading needs the
+        server from make_server() or serve_forever(); under other servers
+        the route answers 501. A request that isn't a WebSocket upgrade
+        gets a 426.
+
+        Each open socket holds one server thread. At most `max_sockets` are
+        open on this route at once; more get a 503 straight away. Messages
+        longer than `max_size` bytes close the connection (code 1009), and
+        with `idle_timeout` (seconds) a connection is dropped when nothing
+        arrives for that long.
+        """
+
+    def batch_endpoint(self, path, max_requests=50, workers=0):
+        """Accept many requests in one HTTP call, as a POST to `path`.
+
+        The body is a JSON list of {"method", "path", "headers", "body"}
+        objects; only "path" is required ("method" defaults to GET). A string
+        body is sent as UTF-8; any other JSON value is sent as JSON. Each
+        entry is run through this application as though it had arrived on
+        its own, with a copy of the batch request's environ: headers the
+        entry doesn't set, such as Cookie and Authorization, are inherited.
+
+        The response is a JSON list, in the same order, of {"status",
+        "headers", "body"} objects, where headers is a list of [name, value]
+        pairs. A body that isn't UTF-8 text is base64-encoded, and marked
+        with "encoding": "base64".
+
+        With `workers`, the entries run in parallel on up to that many
+        threads, shared by every call to this endpoint. More than
+        `max_requests` entries get a 413; a body that isn't a list of
+        requests gets a 400.
+        """
+
 
 class Request(object):
-    """Request objects contain all the information from the HTTP request."""
+    """Request objects contain all the information from the HTTP request.
+
+    request.deadline is the time (on the monotonic clock) by which the handler
+    must return, when the route or app has a timeout; otherwise None.
+    """
+
+    @property
+    def args(self):
+        """The query string parameters, as a QueryArgs.
+
+        Parsed from QUERY_STRING on first access and kept for the rest of the
+        request. Unlike `fields`, this never looks at the request body, so it
+        never reads wsgi.input or imports cgi.
+        """
+
+    @property
+    def fields(self):
+        """Form fields from the query string and (for POSTs and the like) the body.
+
+        A name given more than once maps to a list of its values. For GET and
+        HEAD requests without a body this is built from `args`; otherwise the
+        body is parsed by cgi.FieldStorage (available as `fieldstorage`) on
+        first access.
+        """
+
+    def time_remaining(self):
+        """Seconds until request.deadline, or None if there is no deadline.
+
+        Use it to budget calls to other services, e.g.
+        `request.forward_http(url, timeout=request.time_remaining())`.
+        """
 
     def forward(self, application, env=None):
         """Send this request to a WSGI application.
@@ -169,6 +338,59 @@ class Request(object):
           a Response object containing the result of the WSGI handler.
         """
 
+    def forward_http(self, base_url, path=None, headers=None, timeout=30, pool_size=None):
+        """Proxy this request to an upstream HTTP server.
+
+        The request is sent to base_url's host, at base_url's path followed by
+        `path` (default: this request's path) and the original query string.
+        The request body is streamed from wsgi.input as it's sent, and the
+        returned Response streams the upstream body back to the client as it
+        arrives; neither is held in memory.
+
+        Hop-by-hop headers (Connection, Keep-Alive, Transfer-Encoding, ...,
+        plus anything named in Connection) are removed in both directions,
+        and X-Forwarded-For is extended with the client's address.
+
+        Connections are kept alive and reused from a per-host pool that has at
+        most `pool_size` connections open to that host, idle or in use. When
+        they're all in use, the request waits up to `timeout` seconds for one
+        and then gets a 503. A connection goes back to the pool once its
+        response has been read to the end; responses abandoned partway close
+        their connection instead.
+
+        The body can only be streamed if it hasn't already been read, so don't
+        touch request.fields on requests you intend to forward.
+
+        Args:
+          base_url: "http://host:port/prefix" or "https://..." of the upstream.
+          path: path to request under base_url's path, instead of request.path.
+          headers: dict or list of (name, value) pairs to add to the request.
+          timeout: socket timeout in seconds for connecting and each read.
+          pool_size: most connections open to this host at once (default:
+            8, or whatever it was last set to). Every pool_size given sets
+            the host's limit from then on.
+
+        Return:
+          a Response with the upstream status, headers and (streamed) body.
+
+        Raises:
+          HttpError(504) if the upstream times out, HttpError(502) if it can't
+          be reached or sends an invalid response, HttpError(503) if no
+          connection to it frees up in time.
+        """
+
+
+class QueryArgs(object):
+    """Query string parameters, as request.args.
+
+    args["name"] is the first value given for name (KeyError if none),
+    args.get(name, default) likewise but with a default, args.getall(name)
+    is the list of every value (possibly empty), and args.get_int(name,
+    default) is the first value as an int, or default if it's missing or
+    not an integer. `in`, iteration (over names) and len() work as for a
+    dict. Blank values ("?a=&flag") are kept, as "".
+    """
+
 
 class Response(object):
     """Response contains the status, headers, and content of an HTTP response.
@@ -182,6 +404,19 @@ class Response(object):
     def write(self, content):
         """XXX"""
 
+    def defer(self, fn, *args, **kwargs):
+        """Call fn(*args, **kwargs) in the background after this response is sent.
+
+        Deferred calls are queued once the server closes the response
+        iterable, so the client never waits for them, and run on the app's
+        background worker threads. Use it for mail, audit rows and other work
+        the response doesn't depend on. If the handler then returns another
+        Response, or raises an HttpError, calls deferred on the response it
+        was given move to that one and still run, ahead of its own. Exceptions
+        are written to stderr. See App's
+        background_* settings for pool size and overflow behavior.
+        """
+
     def finalize(self):
         """XXX"""
 
@@ -198,6 +433,86 @@ class FileResponse(Response):
     """A FileResponse sends raw files from your filesystem."""
 
 
+class StaticArchive(object):
+    """Static files served from a single memory-mapped zip archive.
+
+    The archive is mapped into memory once, and its directory is read into a
+    dict up front, with each member's offsets, content type (from its name)
+    and an ETag (from its CRC and size). Serving a file then takes no
+    open/stat/read system calls, only slices of the map.
+
+    Members should be stored uncompressed (zipfile.ZIP_STORED); compressed
+    members work, but are inflated into memory when the archive is indexed.
+    For precompressed content, store "name.gz" beside "name": clients that
+    accept gzip get the .gz member with Content-Encoding: gzip. A .gz member
+    requested by its own name is sent the same way: typed as the file it
+    compresses, with Content-Encoding: gzip.
+
+    Requests whose If-None-Match matches the ETag get a 304.
+    """
+
+    def serve(self, request, name):
+        """Return the response for archive member `name`; raises HttpError(404)."""
+
+
+class ArchiveResponse(Response):
+    """An ArchiveResponse sends one member of a StaticArchive.
+
+    The body is sent in `chunk_size` slices of the memory map. (WSGI requires
+    bytes, so each slice is one memory copy; memoryviews would be rejected by
+    compliant servers.)
+    """
+
+
+class Templates(object):
+    """A small compiled template engine.
+
+    Templates are found by name in `sources` (a dict of name -> template
+    text, handy for single-file apps) or else as files under `directory`.
+    Each is compiled into a Python generator function once, and the code is
+    kept in an LRU cache of `cache_size` templates. With auto_reload, a file
+    is recompiled only when its mtime changes.
+
+    Syntax:
+        {{ expr }}        the value of a Python expression, HTML-escaped
+                          (unless autoescape=False)
+        {{! expr }}       the value, not escaped
+        {% for x in xs %} ... {% endfor %}
+        {% if c %} ... {% elif d %} ... {% else %} ... {% endif %}
+        {% include 'name' %}   another template, with the same variables
+        {# comment #}
+
+    Expressions see the context dict's keys as variables, plus builtins.
+    Malformed templates raise SyntaxError when compiled.
+
+    Templates.default is used by TemplateResponse when it isn't given a
+    Templates object; if unset, a Templates('templates') is created.
+    """
+
+    def render(self, name, context=None):
+        """Render a template to a string."""
+
+    def stream(self, name, context=None):
+        """Render a template, yielding text chunks as they're produced."""
+
+
+class TemplateResponse(StringResponse):
+    """A TemplateResponse streams a rendered template.
+
+    The template is loaded (and compiled if needed) when the response is
+    created, so a missing or malformed template goes through the error
+    handlers like any other exception. It is rendered while the response is
+    sent, in encoded chunks of about `chunk_size` bytes, so the whole page
+    never has to be held in memory. No Content-Length is sent.
+
+    Arguments:
+        name: template name.
+        context: dict of template variables.
+        templates: the Templates to load from (default: Templates.default).
+        kwargs: arguments associated with StringResponse.
+    """
+
+
 class HttpError(Exception, StringResponse):
     """HttpError is a Response that you throw; it also invokes status handlers.
 
@@ -208,7 +523,205 @@ class HttpError(Exception, StringResponse):
     """
 
 
+class WebSocket(object):
+    """An open WebSocket connection, as passed to websocket route handlers.
+
+    receive() waits for the next message, and returns it as a str (text) or
+    bytes (binary), or None once the connection has closed. Iterating over
+    the WebSocket yields messages until then. send() sends a str as text and
+    bytes as binary; it can be called from other threads while one thread
+    is in receive().
+
+    Pings are answered, pongs are dropped, and fragmented messages are
+    reassembled, all within receive(). When the peer closes, the close is
+    echoed and close_code is set to its code (1005 if it gave none, 1006 if
+    the connection just dropped).
+
+    Attributes:
+        request: the Request that was upgraded
+        closed: True once no more messages will arrive
+        close_code: the code the peer closed with
+    """
+
+    def close(self, code=1000, reason=''):
+        """Close the connection with the given code and reason.
+
+        Waits up to close_timeout seconds for the peer to acknowledge. This is
+        done for you when the handler returns.
+        """
+
+    def ping(self, data=b''):
+        """Send a ping frame."""
+
+
+class Session(dict):
+    """The dict behind request.session.
+
+    Assigning, deleting, clear(), pop(), update() etc. mark it dirty, and
+    only dirty sessions are written back. If you mutate a value in place
+    (`request.session['cart'].append(x)`), set `session.dirty = True`.
+    Clearing a session removes it from the store and expires the cookie.
+    """
+
+
+class Sessions(object):
+    """Signed-cookie sessions for an App.
+
+    Enable with `app.sessions = Sessions(secret)`. The cookie holds only a
+    random session ID, signed with HMAC-SHA256 using `secret`; the data lives
+    in `store` (a MemorySessionStore by default). Cookies that fail the
+    signature check are ignored.
+
+    Nothing happens for requests that don't use request.session: the cookie
+    is read and the store consulted only on first access, and the store is
+    written (and a cookie issued for a new session) only when the session
+    was modified.
+
+    A store is any object with `load(sid) -> dict or None`, `save(sid, dict)`
+    and `delete(sid)`, safe to call from multiple threads.
+
+    Arguments:
+        secret: str or bytes key for signing session IDs.
+        store: session store; defaults to MemorySessionStore().
+        cookie_name, cookie_path: name and Path of the cookie.
+        secure: add the Secure flag to the cookie.
+        max_age: cookie Max-Age in seconds; None for a browser-session cookie.
+    """
+
+
+class MemorySessionStore(object):
+    """In-process session store.
+
+    Holds at most `max_entries` sessions, evicting the least recently used,
+    and drops sessions not used for `ttl` seconds. Each load returns a copy,
+    so concurrent requests on the same session don't share a dict. Data is
+    not shared between processes; use SqliteSessionStore for that.
+    """
+
+
+class SqliteSessionStore(object):
+    """Session store in a sqlite database file, shared by every process using it.
+
+    Session data is stored as JSON. Sessions expire `ttl` seconds after they
+    were last written (loads don't extend them, since that would mean a write
+    per request). Each thread uses its own connection; `timeout` is how long
+    to wait for another process's write lock.
+    """
+
+
+class SharedCache(object):
+    """A bytes cache shared by every process on the host that opens it.
+
+    The first process to open a name creates a fixed-size table in shared
+    memory (multiprocessing.shared_memory, Python 3.8+), and the others
+    attach to it, so one warm cache serves all of an app's worker
+    processes. Every process must pass the same slots, slot_size and ways;
+    a mismatch raises ValueError. POSIX only.
+
+        cache = SharedCache('myapp')
+        page = cache.get(request.path)
+        if page is None:
+            page = render(...).encode('utf-8')
+            cache.set(request.path, page, ttl=60)
+
+    Keys are str or bytes, and values are bytes. A key and its value share
+    one slot of `slot_size` bytes, less a 40-byte header, and set() returns
+    False for anything bigger. Each key hashes to a bucket of `ways` slots.
+    When a bucket is full, the entry read least recently is evicted.
+    Entries set with a ttl (in seconds) read as missing once it has passed.
+
+    Reads take no locks. Writes lock one of `stripes` stripes, both within
+    the process and across processes (via fcntl on a lock file in the temp
+    directory).
+
+    The memory stays allocated after every process has closed it, so that
+    restarting a worker doesn't empty the cache; call unlink() to free it.
+    """
+
+    def get(self, key, default=None):
+        """Return the value stored for key, or default."""
+
+    def set(self, key, value, ttl=None):
+        """Store value (bytes) for key. Returns False if it doesn't fit in a slot."""
+
+    def delete(self, key):
+        """Remove key, if it's there."""
+
+    def stats(self):
+        """Return this process's hits, misses, sets, evictions and rejected (too big) sets."""
+
+    def close(self):
+        """Detach this process from the cache."""
+
+    def unlink(self):
+        """Free the shared memory. Call once, from one process, when the cache is no longer wanted."""
+
+
+class AccessLog(object):
+    """An access log that stays off the request path.
+
+    Set app.access_log = AccessLog(...) to use it. Each request puts one
+    small record on a bounded queue when the server closes the response.
+    A background thread then formats the records and writes them in
+    batches, flushing once per batch. If the queue is full the record is
+    dropped rather than blocking the request, and `dropped` counts those;
+    the next batch written says how many were lost. When the app's
+    tracebacks_to_stderr is on, tracebacks from unhandled exceptions go
+    through the same queue instead of to stderr. With an access log set,
+    make_server() no longer writes its own line per request; requests
+    handed to a mounted application are logged here too, with no route.
+
+    Records have: time, remote_addr, method, path, query, protocol,
+    route (the path pattern that matched, or None), status, bytes (body
+    bytes sent) and duration (seconds, from the start of handling until
+    the server closed the response). Override format(record) to change
+    the line layout.
+
+    Arguments:
+        target: a stream, or a filename to append to (default: stderr)
+        queue_size: most records waiting to be written
+        batch_size: most records per write
+        json_lines: write each record as a JSON object, not a text line
+    """
+
+    def format(self, record):
+        """Return the line (with its newline) to write for a record dict."""
+
+    def flush(self, timeout=None):
+        """Wait until everything queued has been written.
+
+        App.shutdown() calls this. Returns False if timeout ran out first.
+        """
+
+
 class App(Router):
+    """A WSGI application.
+
+    Class attributes you may want to override per app:
+        response_class: the Response type handlers receive by default.
+        tracebacks_to_http / tracebacks_to_stderr: where to report exceptions.
+        sessions: a Sessions instance to enable request.session.
+        access_log: an AccessLog to record requests and tracebacks through.
+        request_timeout: default `timeout` for every route, in seconds.
+        max_body_size: default `max_body` for every route, in bytes.
+        timeout_workers: most handlers that can run under a deadline at once.
+        timeout_queue: most handlers waiting for one of those threads; more
+            are answered 503. A queued handler whose deadline passes first
+            is never called.
+        process_workers: size of the process pool for executor='process'
+            routes (default: the number of CPUs). It's started on first use,
+            and stopped by shutdown().
+        background_workers: threads running Response.defer() calls.
+        background_queue: most deferred calls waiting to run.
+        background_overflow: what to do with a deferred call when that queue
+            is full: 'drop' it (and log that), or run it 'inline' in the
+            request thread after the response is sent.
+        adaptive_routing: count hits per route, and every adaptive_interval
+            routed requests re-sort the routing table so busy routes are
+            tried first (see route_hits()).
+
+    app.timeouts counts requests answered with a 504 because their deadline passed.
+    """
 
     def request_handler(self, request):
         """Top-level request handler."""
@@ -216,8 +729,59 @@ class App(Router):
     def error_handler(self, request, http_error):
         """Top-level error handler. Override to incercept every error."""
 
+    def route_stats(self):
+        """Return live counters for routes with admission limits, keyed by path.
+
+        Each value is a dict with `in_flight` (handlers running now), `queued`
+        (requests waiting for a slot) and `rejected` (503s sent so far).
+        """
+
+    def route_hits(self):
+        """Return (path, methods, hits) for every route, in the order they're tried.
+
+        Hits are only counted with adaptive_routing on. Routes are normally
+        tried in registration order, and the first match wins. Adaptive
+        routing moves busier routes earlier, but never moves one route past
+        another that might match the same request. Two routes are
+        independent only if their method lists don't intersect, or if the
+        literal text their patterns start with shows that no path can match
+        both (for example "/users/<id>" and "/static/<name:.*>"). A raw
+        regex route that starts with a group or a class, or that uses "|",
+        keeps its place relative to every other route.
+        """
+
+    def freeze(self):
+        """Compile the routing table and lock it against further changes.
+
+        Registering routes or error handlers is always safe while the app is
+        serving: each registration builds a new table and swaps it in, so
+        request threads never take a lock. Calling freeze() once setup is done
+        makes that table final; any later `route` or `errorhandler` call (on
+        the app or on a Router feeding it) raises RuntimeError. Frozen routes
+        also keep their options (timeout, max_body, vars, ...) in the table
+        itself, so dispatch reads them without per-request lookups; the
+        app-wide defaults, request_timeout and max_body_size, are read once
+        here too, so set them before freezing.
+
+        Returns the app, so `app = App(router).freeze()` works.
+        """
+
+    def shutdown(self, timeout=None):
+        """Wait for queued and running deferred calls to finish, then for the
+        access log (if any) to be written out.
+
+        serve_forever() calls this on its way out. Returns False if timeout
+        (in seconds) ran out first.
+        """
+
     def make_server(self, port=8080, host='', threaded=True):
-        """XXX"""
+        """Return a wsgiref server for this app (call its serve_forever()).
+
+        Beyond plain wsgiref, the server supports websocket routes and
+        answers `Expect: 100-continue`. The 100 Continue is sent only when
+        the application first reads the request body, so a request that is
+        rejected first (404, 405, a 413 from max_body) is never uploaded.
+        """
 
     def serve_forever(self, port=8080, host='', threaded=True):
         """XXX"""
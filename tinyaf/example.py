@@ -10,7 +10,7 @@ def home(request, response):
     return "<html><h1>Hello World</h1></html>"
 
 
-@app.route('/sleep/<seconds:\d>')
+@app.route('/sleep/<seconds:\d>', timeout=5)
 def sleepy_dave(request, response):
     import time
     time.sleep(int(request['seconds']))
@@ -32,11 +32,15 @@ def forward(location, code=301):
 app.route("/files")(forward('/files/', 302))
 
 
+templates = tinyaf.Templates(sources={
+    'dirlist.html': '{% for f in files %}<a href="{{ f }}">{{ f }}</a><br/>\n{% endfor %}',
+})
+
+
 @app.route("/files/")
 def dirlist(request, response):
-    for f in os.listdir():
-        if not f.startswith(".") and os.path.isfile(f):
-            response.write("<a href=\"{0}\">{0}<a/><br/>\n".format(f))
+    files = [f for f in os.listdir() if not f.startswith(".") and os.path.isfile(f)]
+    return tinyaf.TemplateResponse('dirlist.html', {'files': files}, templates=templates)
 
 
 @app.route('/files/<name>')
@@ -1,18 +1,28 @@
-import cgi
-import json
-import mimetypes
 import os
 import re
 import sys
-import traceback
+import threading
+import time
 import wsgiref.headers
-import wsgiref.simple_server
 if sys.version_info[0] == 2:  # py2      # pylint disable import error due to python version
-    import SocketServer as socketserver  # pylint: disable=E0401
     import httplib                       # pylint: disable=E0401
 else:  # py3
-    import socketserver                  # pylint: disable=E0401
     import http                          # pylint: disable=E0401
+# cgi, json, mimetypes, traceback, socketserver and wsgiref.simple_server are imported where
+# they're used, so that apps (and CLI/CGI invocations) that never need them don't pay to load them.
+
+__all__ = ['Router', 'Request', 'QueryArgs', 'Response', 'StringResponse', 'JsonResponse', 'FileResponse',
+           'HttpError', 'WebSocket', 'App', 'Templates', 'TemplateResponse', 'StaticArchive', 'ArchiveResponse',
+           'Session', 'Sessions', 'MemorySessionStore', 'SqliteSessionStore', 'SharedCache',
+           'AccessLog']
+
+# Precomputed status phrases/descriptions and WSGI status lines, keyed by code.
+if sys.version_info[0] == 2:
+    _STATUS = dict((c, (p, "")) for c, p in httplib.responses.items() if isinstance(c, int))
+else:
+    _STATUS = dict((int(s), (s.phrase, s.description)) for s in http.HTTPStatus)
+_STATUS_LINES = dict((c, "%i %s" % (c, p)) for c, (p, _) in _STATUS.items())
+_clock = getattr(time, 'monotonic', time.time)  # py2 has no monotonic clock
 
 
 class Router(object):
@@ -20,11 +30,15 @@ class Router(object):
     def __init__(self):
         self.entries = []
         self.apps = []
+        self._lock = threading.Lock()  # serializes registration against apps attaching
 
     def _router_update(self, **kwargs):
-        self.entries.append(kwargs.copy())
-        for app in self.apps:
-            app._router_update(**kwargs)
+        with self._lock:
+            if any(app.frozen for app in self.apps):  # check first, so a refusal leaves no app changed
+                raise RuntimeError("An app using this router is frozen; routes and error handlers can't be changed.")
+            for app in self.apps:
+                app._router_update(**kwargs)
+            self.entries.append(kwargs.copy())
 
     def route(self, path, handler=None, methods=None, **kwargs):  # additional: response_class, vars
         kwargs.update(dict(routetype='route', path=path, methods=methods))
@@ -42,32 +56,161 @@ class Router(object):
         if handler: return decorator(handler)
         return decorator
 
+    def mount(self, prefix, application):
+        prefix = "/" + prefix.strip("/")
+        if prefix == "/": raise ValueError("can't mount an application at the root path")
+        self._router_update(routetype='mount', prefix=prefix, handler=application)
+        return application
+
+    def static_archive(self, prefix, archive, **kwargs):  # additional: index
+        if not isinstance(archive, StaticArchive):
+            archive = StaticArchive(archive, **kwargs)
+        self.route(prefix.rstrip("/") + "/<name:.*>", methods=['GET', 'HEAD'],
+                   handler=lambda request, response: archive.serve(request, request.vars['name']))
+        return archive
+
+    def websocket(self, path, handler=None, max_sockets=100, max_size=2 ** 20, idle_timeout=None,
+                  **kwargs):  # additional: vars
+        def decorator(fn):
+            self.route(path, methods=['GET'], max_concurrency=max_sockets, timeout=None, handler=(
+                lambda request, response: WebSocket.serve(request, response, fn, max_size, idle_timeout)),
+                **kwargs)
+            return fn
+        if handler: return decorator(handler)
+        return decorator
+
+    def batch_endpoint(self, path, max_requests=50, workers=0):
+        endpoint = _BatchEndpoint(max_requests, workers)
+        self.route(path, methods=['POST'], handler=endpoint, response_class=JsonResponse)
+        return endpoint
+
 
 class Request(object):
     """Request objects contain all the information from the HTTP request."""
-    def __init__(self, environ):
+    __slots__ = ('vars', '_route_match', 'environ', 'path', 'method', 'app', 'deadline', '_fieldstorage',
+                 '_fields', '_args', '_headers', '_session', '_route', '_upstreams',
+                 '__dict__')  # __dict__ keeps arbitrary user attributes working
+    def __init__(self, environ, app=None):
         self.vars = {}  # populated when the routing decision is calcuated
         self._route_match = None  # updated to contain the re match object from the routing decision 
+        self._headers = self._fieldstorage = self._fields = self._args = self._session = None  # lazy
+        self._route = None  # the route entry that matched
+        self._upstreams = None  # _UpstreamBody objects from forward_http(), closed with the response
+        self.app = app
+        self.deadline = None  # _clock() value by which the response must start, if any
         self.environ = environ
         self.path = environ['PATH_INFO']
         self.method = environ['REQUEST_METHOD']
-        self.fieldstorage = cgi.FieldStorage(environ=environ, fp=environ.get('wsgi.input', None))
-        self.fields = {k: self.fieldstorage[k].value
-                       for k in self.fieldstorage} if self.fieldstorage.list else {}
-        hlist = [(k[5:].replace("_", "-").title(), v) for k, v in environ.items() if k.startswith("HTTP_")]
-        self.headers = wsgiref.headers.Headers(hlist)
+
+    @property
+    def fieldstorage(self):  # parsing reads wsgi.input, so it's left until someone asks
+        if self._fieldstorage is None:
+            import cgi
+            self._fieldstorage = cgi.FieldStorage(environ=self.environ,
+                                                  fp=self.environ.get('wsgi.input', None))
+        return self._fieldstorage
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            if self.method in ('GET', 'HEAD') and not self.environ.get('CONTENT_LENGTH'):
+                self._fields = {}  # no body, so the query string is all there is; skip cgi
+                for k, v in self.args._values.items():
+                    v = [x for x in v if x]  # cgi drops blank values
+                    if v: self._fields[k] = v[0] if len(v) == 1 else v
+            else:
+                fs = self.fieldstorage  # getvalue(): a list for repeated names, like the above
+                self._fields = {k: fs.getvalue(k) for k in fs} if fs.list else {}
+        return self._fields
+
+    @property
+    def args(self):
+        if self._args is None:
+            self._args = QueryArgs(self.environ.get('QUERY_STRING', ''))
+        return self._args
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            self._headers = wsgiref.headers.Headers([(k[5:].replace("_", "-").title(), v)
+                                                     for k, v in self.environ.items() if k[:5] == "HTTP_"])
+        return self._headers
+
+    def time_remaining(self):
+        """Seconds left before the deadline (never negative), or None if there's no deadline."""
+        return None if self.deadline is None else max(0.0, self.deadline - _clock())
+
+    @property
+    def session(self):
+        if self._session is None:
+            if self.app is None or self.app.sessions is None:
+                raise AttributeError("sessions are not enabled; set app.sessions = Sessions(...)")
+            self._session = self.app.sessions.load(self)
+        return self._session
 
     def forward(self, application, env=None):
         environ = self.environ.copy()
         if env: environ.update(env)
-        self.__response = None  # place to stick the response object in callback, else we lose it.
-        def start_response(statusline, headers):
+        response = []  # place to stick the response object in callback, else we lose it.
+        def start_response(statusline, headers, exc_info=None):
             code, status = statusline.split(" ", 1)
-            self.__response = Response(content=None, code=int(code), headers=headers, status=status)
-        content = application(self.environ, start_response)
-        if not self.__response: raise AssertionError("start_response not called.")
-        self.__response.content = content
-        return self.__response
+            response[:] = [Response(content=None, code=int(code), headers=headers, status=status)]
+        content = application(environ, start_response)
+        if not response: raise AssertionError("start_response not called.")
+        response[0].content = content
+        return response[0]
+
+    def forward_http(self, base_url, path=None, headers=None, timeout=30, pool_size=None):
+        if sys.version_info[0] == 2: from urlparse import urlsplit  # pylint: disable=E0401
+        else: from urllib.parse import urlsplit
+        import socket
+        url = urlsplit(base_url)
+        target = url.path.rstrip('/') + (self.path if path is None else path)
+        if self.environ.get('QUERY_STRING'):
+            target += '?' + self.environ['QUERY_STRING']
+        out = _strip_hop_by_hop([(k, v) for k, v in self.headers.items()
+                                 if k.lower() not in ('host', 'x-forwarded-for')])
+        if self.environ.get('CONTENT_TYPE'):
+            out.append(('Content-Type', self.environ['CONTENT_TYPE']))
+        remote = self.environ.get('REMOTE_ADDR', '')
+        forwarded_for = self.environ.get('HTTP_X_FORWARDED_FOR')
+        out.append(('X-Forwarded-For', "%s, %s" % (forwarded_for, remote) if forwarded_for else remote))
+        out.extend((headers.items() if hasattr(headers, 'items') else headers) or ())
+        length = int(self.environ.get('CONTENT_LENGTH') or 0)
+        if length and self._fieldstorage is not None:
+            raise RuntimeError("request body was already consumed by request.fields")
+        pool = _HttpPool.get(url.scheme, url.netloc, pool_size)
+        while True:
+            conn, reused = pool.acquire(timeout)
+            try:
+                conn.putrequest(self.method, target, skip_accept_encoding=True)
+                for k, v in out:
+                    conn.putheader(k, v)
+                if length:
+                    conn.putheader('Content-Length', str(length))
+                conn.endheaders()
+                remaining, read = length, self.environ['wsgi.input'].read
+                while remaining > 0:  # stream the body through; never hold all of it
+                    chunk = read(min(remaining, FileResponse.chunk_size))
+                    if not chunk: break
+                    conn.send(chunk)
+                    remaining -= len(chunk)
+                resp = conn.getresponse()
+            except socket.timeout:
+                pool.discard(conn)
+                raise HttpError(504)
+            except (socket.error, pool.client.HTTPException):
+                pool.discard(conn)
+                if reused and not length:
+                    continue  # the upstream dropped an idle keep-alive connection; try a fresh one
+                raise HttpError(502)
+            except BaseException:
+                pool.discard(conn)
+                raise
+            body = _UpstreamBody(pool, conn, resp)
+            if self._upstreams is None: self._upstreams = []
+            self._upstreams.append(body)
+            return Response(body, resp.status, _strip_hop_by_hop(resp.getheaders()), status=resp.reason)
 
     def __getitem__(self, key):
         try:
@@ -79,45 +222,103 @@ class Request(object):
         return key in self.vars or key in self.fields
 
 
+class QueryArgs(object):
+    """Query string parameters. Indexing gives a name's first value; getall() gives every value."""
+    __slots__ = ('_values',)
+
+    def __init__(self, query_string):
+        values = self._values = {}
+        if not query_string:
+            return
+        unquote = None
+        for part in query_string.split('&'):
+            if not part:
+                continue
+            name, _, value = part.partition('=')
+            if '%' in part or '+' in part:  # only decode what needs decoding
+                if unquote is None:
+                    if sys.version_info[0] == 2: from urllib import unquote_plus as unquote  # pylint: disable=E0611
+                    else: from urllib.parse import unquote_plus as unquote
+                name, value = unquote(name), unquote(value)
+            if name in values: values[name].append(value)
+            else: values[name] = [value]
+
+    def __getitem__(self, name):
+        return self._values[name][0]
+
+    def __contains__(self, name):
+        return name in self._values
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, name, default=None):
+        values = self._values.get(name)
+        return values[0] if values else default
+
+    def getall(self, name):
+        return list(self._values.get(name, ()))
+
+    def get_int(self, name, default=None):
+        """The first value as an int, or default if it's missing or not an integer."""
+        try:
+            return int(self._values[name][0])
+        except (KeyError, ValueError):
+            return default
+
+
 class Response(object):
     """Response objects manage translating your output to WSGI."""
     def __init__(self, content=None, code=200, headers=None, **kwargs):
         self.response_instance = self  # override to send another object as the wsgi response
+        self._deferred = None  # (fn, args, kwargs) to run after the response is sent
         self._default_headers = {}  # Headers that will apply if no competing headers are set
         self.content = content or []
         self.status = kwargs.get('status', None)
         self.code = code
-        headers = headers or []  # headers can be either a list of tuples or a dict
-        self.headers = wsgiref.headers.Headers(list(getattr(headers, 'items', lambda: headers)()))
+        if headers is None: headers = []  # headers can be either a list of tuples or a dict
+        else: headers = list(headers.items() if hasattr(headers, 'items') else headers)
+        self.headers = wsgiref.headers.Headers(headers)
 
     def _finalize_wsgi(self, environ, start_response):
-        self.environ = environ
         self.start_response = start_response
+        headers = self._finalize_headers(environ)
+        code = self.code
+        self.start_response(("%i %s" % (code, self.status)) if self.status else
+                            (_STATUS_LINES.get(code) or "%i Unknown" % code), headers)
+
+    def _finalize_headers(self, environ):
+        """Run finalize(), and return the header list to send."""
+        self.environ = environ
         self.content = self.finalize() or self.content or []
         self.code = self.code or 500
-        for h, v in self._default_headers.items():
-            self.headers.setdefault(h, str(v))
-        self.start_response("%i %s" % (self.code, self.status or self.http_status()[0]),
-                            list(self.headers.items()))
+        headers = self.headers._headers  # the underlying list; sent as-is when there are no defaults
+        if self._default_headers:  # default header keys are lowercase; add the ones not already set
+            present = set(h.lower() for h, _ in headers)
+            headers = headers + [(h, str(v)) for h, v in self._default_headers.items() if h not in present]
+        return headers
 
     def write(self, content):
         self.content.append(content)
 
+    def defer(self, fn, *args, **kwargs):
+        if self._deferred is None: self._deferred = []
+        self._deferred.append((fn, args, kwargs))
+
     def finalize(self):
         pass
 
     def __iter__(self):
         return iter(self.content)
 
+    def close(self):  # called by the WSGI server; pass it along to iterables that need it
+        if hasattr(self.content, 'close'): self.content.close()
+
     def http_status(self):
-        if sys.version_info[0] == 2:
-            return httplib.responses.get(self.code, 'Unknown'), ""
-        else:
-            try:
-                s = http.HTTPStatus(self.code)  # pylint: disable=E1120
-                return s.phrase, s.description
-            except ValueError:
-                return "Unknown", ""
+        return _STATUS.get(self.code, ("Unknown", ""))
 
 
 class StringResponse(Response):
@@ -129,7 +330,10 @@ class StringResponse(Response):
         self.charset = charset
 
     def finalize(self):
-        out = ''.join(self.content).encode(self.charset)
+        if len(self.content) == 1 and isinstance(self.content[0], bytes):
+            out = self.content[0]  # already encoded
+        else:
+            out = ''.join(self.content).encode(self.charset)
         self._default_headers['content-type'] = "%s; charset=%s" % (self.content_type, self.charset)
         self._default_headers['content-length'] = len(out)
         return (out, )
@@ -148,6 +352,7 @@ class JsonResponse(StringResponse):
         self.val = val
 
     def finalize(self):
+        import json
         self.content = (json.dumps(self.val, sort_keys=self.sort_keys, **self.json_args), )
         return StringResponse.finalize(self)
 
@@ -161,6 +366,7 @@ class FileResponse(Response):
         if not hasattr(file, 'read'):
             file = open(file, 'rb')
         if not content_type and hasattr(file, 'name'):
+            import mimetypes
             content_type = mimetypes.guess_type(file.name)[0]
         if content_type:
             self._default_headers['content-type'] = content_type
@@ -169,14 +375,201 @@ class FileResponse(Response):
         self.file = file
 
     def finalize(self):
-        if 'wsgi.file_wrapper' in self.environ:
+        if 'wsgi.file_wrapper' in self.environ and self.environ['REQUEST_METHOD'] != 'HEAD':
             self.response_instance = self.environ['wsgi.file_wrapper'](self.file, self.chunk_size)
 
     def close(self):
         if self._close and hasattr(self.file, 'close'): self.file.close()
 
     def __iter__(self):
-        return iter(lambda: self.file.read(self.chunk_size), '')
+        return iter(lambda: self.file.read(self.chunk_size), b'')
+
+
+class StaticArchive(object):
+    """Static files served from one memory-mapped zip archive, indexed once up front."""
+    def __init__(self, path, index='index.html'):
+        import mimetypes
+        import mmap
+        import struct
+        import zipfile
+        self.index = index
+        self.members = {}  # name -> (data, start, end, etag, content type, content encoding)
+        with open(path, 'rb') as f:  # the map stays valid after the file is closed
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with zipfile.ZipFile(path) as archive:  # offsets account for anything prepended to the zip
+            for info in archive.infolist():
+                if info.filename.endswith('/'):
+                    continue
+                if info.compress_type == zipfile.ZIP_STORED:
+                    data = self.map  # the local header's extra field can differ from the directory's
+                    name_len, extra_len = struct.unpack('<HH', self.map[info.header_offset + 26:
+                                                                        info.header_offset + 30])
+                    start = info.header_offset + 30 + name_len + extra_len
+                else:  # compressed members are inflated once, here, rather than per request
+                    data, start = archive.read(info), 0
+                gzipped = info.filename.endswith('.gz')  # typed as the file it compresses, however it's asked for
+                name = info.filename[:-3] if gzipped else info.filename
+                self.members[info.filename] = (data, start, start + info.file_size,
+                                               '"%08x-%x"' % (info.CRC, info.file_size),
+                                               mimetypes.guess_type(name)[0] or 'application/octet-stream',
+                                               'gzip' if gzipped else None)
+
+    def serve(self, request, name):
+        """Return an ArchiveResponse for a member, honoring If-None-Match and gzip variants."""
+        if name == '' or name.endswith('/'):
+            name += self.index
+        entry = self.members.get(name)
+        if entry is None:
+            raise HttpError(404)
+        headers = {}
+        if name + '.gz' in self.members:
+            if 'gzip' in request.environ.get('HTTP_ACCEPT_ENCODING', ''):
+                entry = self.members[name + '.gz']
+            headers = {'Vary': 'Accept-Encoding'}
+        if entry[5]:
+            headers['Content-Encoding'] = entry[5]
+        if request.environ.get('HTTP_IF_NONE_MATCH') == entry[3]:
+            headers['ETag'] = entry[3]
+            return Response(code=304, headers=headers)
+        return ArchiveResponse(entry, headers=headers)
+
+
+class ArchiveResponse(Response):
+    """An ArchiveResponse sends one member of a StaticArchive."""
+    chunk_size = 262144
+    def __init__(self, entry, **kwargs):
+        Response.__init__(self, **kwargs)
+        self.data, self.start, self.end, etag, content_type, _ = entry
+        self._default_headers['content-type'] = content_type
+        self._default_headers['content-length'] = self.end - self.start
+        self._default_headers['etag'] = etag
+
+    def __iter__(self):  # slices of the map: no open/stat/read calls, just a copy into bytes
+        data, end, size = self.data, self.end, self.chunk_size
+        for i in range(self.start, end, size):
+            yield data[i:min(i + size, end)]
+
+
+class Templates(object):
+    """Loads, compiles and caches templates from a directory (and/or a dict of sources)."""
+    _token = re.compile(r"(\{\{!?.*?\}\}|\{%.*?%\}|\{#.*?#\})", re.S)
+    default = None  # used by TemplateResponse when no Templates object is given
+
+    def __init__(self, directory='templates', sources=None, cache_size=128, auto_reload=True,
+                 autoescape=True):
+        import collections
+        self.directory, self.sources = directory, dict(sources or {})
+        self.cache_size, self.auto_reload, self.autoescape = cache_size, auto_reload, autoescape
+        self.cache = collections.OrderedDict()  # name -> (mtime, function code), LRU order
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        """Return the compiled template (a code object), compiling or reloading it as needed."""
+        path = mtime = None
+        if name not in self.sources:
+            path = os.path.join(self.directory, name)
+        with self.lock:
+            entry = self.cache.pop(name, None)
+            if entry is not None:
+                self.cache[name] = entry  # now most recently used
+        if entry is not None and (path is None or not self.auto_reload):
+            return entry[1]
+        if path is not None:
+            mtime = os.stat(path).st_mtime
+            if entry is not None and entry[0] == mtime:
+                return entry[1]
+            with open(path, 'rb') as f:
+                source = f.read().decode('utf-8')
+        else:
+            source = self.sources[name]
+        code = self.compile(source, name)
+        with self.lock:
+            self.cache[name] = (mtime, code)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return code
+
+    def compile(self, source, name='<template>'):
+        """Translate template source into the code object of a generator function."""
+        lines, depth, blocks = ["def _template():", "  if 0: yield ''"], 1, []
+        out = lambda stmt: lines.append("  " * depth + stmt)
+        for i, token in enumerate(self._token.split(source)):
+            if i % 2 == 0:  # literal text
+                if token: out("yield %r" % (token,))
+            elif token.startswith('{{!'):
+                out("yield _str(%s)" % (token[3:-2].strip()))
+            elif token.startswith('{{'):
+                out("yield %s(%s)" % ('_escape' if self.autoescape else '_str', token[2:-2].strip()))
+            elif token.startswith('{%'):
+                words = token[2:-2].strip().split(None, 1)
+                keyword, rest = words[0] if words else '', words[1] if len(words) > 1 else ''
+                if keyword in ('for', 'if'):
+                    out("%s %s:" % (keyword, rest))
+                    blocks.append(keyword)
+                    depth += 1
+                elif keyword in ('elif', 'else') and blocks and blocks[-1] == 'if':
+                    depth -= 1
+                    out("%s %s:" % (keyword, rest) if rest else "else:")
+                    depth += 1
+                elif keyword in ('endfor', 'endif') and blocks and blocks.pop() == keyword[3:]:
+                    depth -= 1
+                elif keyword == 'include':
+                    out("for _chunk in _include(%s, dict(globals(), **locals())): yield _chunk" % (rest))
+                else:
+                    raise SyntaxError("unexpected %s in template %s" % (token, name))
+        if blocks:
+            raise SyntaxError("unclosed {%% %s %%} in template %s" % (blocks[-1], name))
+        module = compile("\n".join(lines), name, 'exec')
+        return [c for c in module.co_consts if hasattr(c, 'co_code')][0]
+
+    def stream(self, name, context=None):
+        """Render a template, yielding text chunks as they're produced."""
+        return self._generate(self.get(name), context or {})
+
+    def render(self, name, context=None):
+        return ''.join(self.stream(name, context))
+
+    def _generate(self, code, namespace):
+        import types
+        if sys.version_info[0] == 2: import cgi as html; import __builtin__ as builtins  # pylint: disable=E0401
+        else: import html; import builtins
+        namespace = dict(namespace, _str=_text, _escape=lambda v: html.escape(_text(v), True),
+                         _include=lambda name, ns: self._generate(self.get(name), ns),
+                         __builtins__=builtins)
+        return types.FunctionType(code, namespace)()
+
+
+_text = str if sys.version_info[0] != 2 else unicode  # pylint: disable=E0602
+
+
+class TemplateResponse(StringResponse):
+    """A TemplateResponse streams a rendered template."""
+    chunk_size = 8192
+    def __init__(self, name, context=None, templates=None, **kwargs):
+        StringResponse.__init__(self, **kwargs)
+        if templates is None:
+            if Templates.default is None:
+                Templates.default = Templates()
+            templates = Templates.default
+        self.templates = templates
+        self.template = self.templates.get(name)  # load now, so errors reach the error handlers
+        self.context = context or {}
+
+    def finalize(self):
+        self._default_headers['content-type'] = "%s; charset=%s" % (self.content_type, self.charset)
+        return self._encoded(self.templates._generate(self.template, self.context))
+
+    def _encoded(self, chunks):
+        """Gather template chunks into writes of about chunk_size."""
+        buf, size = [], 0
+        for chunk in chunks:
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= self.chunk_size:
+                yield ''.join(buf).encode(self.charset)
+                buf, size = [], 0
+        if buf:
+            yield ''.join(buf).encode(self.charset)
 
 
 class HttpError(Exception, StringResponse):
@@ -186,27 +579,1398 @@ class HttpError(Exception, StringResponse):
         Exception.__init__(self, "HTTP %i" % (code))
         StringResponse.__init__(self, content, code=code, **kwargs)
 
+    def __getattr__(self, name):  # only reached when normal lookup fails
+        if name == 'traceback' and self.__dict__.get('exc_info'):
+            import traceback
+            self.traceback = ''.join(traceback.format_exception(*self.exc_info))
+            return self.traceback
+        raise AttributeError(name)
+
+
+_ERROR_PAGES = {}  # (code, charset[, allow, method]) -> default error page, encoded
+
+
+class _WebSocketError(Exception):
+    """A protocol violation by the peer; code is the close code to fail the connection with."""
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.code = code
+
+
+def _unmask(data, mask):
+    if not hasattr(int, 'from_bytes'):  # py2
+        mask = bytearray(mask)
+        return bytes(bytearray(b ^ mask[i & 3] for i, b in enumerate(bytearray(data))))
+    n = len(data)  # XOR the whole payload as one big integer rather than byte by byte
+    key = (mask * (n // 4 + 1))[:n]
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(key, 'big')).to_bytes(n, 'big')
+
+
+class WebSocket(object):
+    """One server-side WebSocket connection; websocket routes get it as their second argument."""
+    GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+    close_timeout = 5  # seconds to wait for the peer to answer our close frame
+
+    def __init__(self, request, sock, rfile, max_size=2 ** 20):
+        self.request = request
+        self.sock, self.rfile = sock, rfile
+        self.max_size = max_size
+        self.closed = False  # no more messages will arrive
+        self.close_code = None  # what the peer closed with (1005: no code, 1006: connection lost)
+        self._close_sent = False
+        self._send_lock = threading.Lock()
+        self._recv_lock = threading.RLock()  # close() reads the peer's reply under it, from receive()
+
+    @classmethod
+    def serve(cls, request, response, handler, max_size=2 ** 20, idle_timeout=None):
+        """Upgrade the request's connection, run handler(request, websocket), then close it."""
+        environ = request.environ
+        if 'websocket' not in environ.get('HTTP_UPGRADE', '').lower():
+            raise HttpError(426, "This URL only accepts WebSocket connections")
+        if environ.get('HTTP_SEC_WEBSOCKET_VERSION') != '13':
+            raise HttpError(426, headers={'Sec-WebSocket-Version': '13'})
+        key = environ.get('HTTP_SEC_WEBSOCKET_KEY')
+        if not key:
+            raise HttpError(400, "Missing Sec-WebSocket-Key")
+        upgrade = environ.get('tinyaf.upgrade')  # set by App.make_server's request handler
+        if upgrade is None:
+            raise HttpError(501, "WebSockets need the built-in server")
+        import base64, hashlib
+        accept = base64.b64encode(hashlib.sha1(key.encode('ascii') + cls.GUID).digest()).decode('ascii')
+        sock, rfile = upgrade()
+        sock.sendall(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      "Sec-WebSocket-Accept: %s\r\n\r\n" % (accept)).encode('ascii'))
+        sock.settimeout(idle_timeout)
+        ws = cls(request, sock, rfile, max_size)
+        try:
+            handler(request, ws)
+        except Exception:
+            ws.close(1011)
+            raise
+        finally:
+            ws.close()
+        response.code = 101  # for the access log; the server sends nothing more on this connection
+        return response
+
+    def __iter__(self):
+        while True:
+            message = self.receive()
+            if message is None:
+                return
+            yield message
+
+    def receive(self):
+        """Wait for the next message: a str for text, bytes for binary, or None once closed."""
+        import struct
+        with self._recv_lock:
+            parts, size, opcode = [], 0, None
+            while not self.closed:
+                try:
+                    fin, op, payload = self._read_frame()
+                    if op >= 8:  # control frames can arrive between the fragments of a message
+                        if not fin or len(payload) > 125:
+                            raise _WebSocketError(1002)
+                        if op == 9:
+                            self._send(10, payload)
+                        elif op == 8:
+                            self.close_code = struct.unpack('!H', payload[:2])[0] if len(payload) >= 2 else 1005
+                            self._send(8, payload[:2])  # echo the close, unless we sent ours already
+                            self.closed = True
+                        elif op != 10:
+                            raise _WebSocketError(1002)
+                        continue
+                    if (op == 0) == (opcode is None) or op > 2:  # stray continuation or interleaved message
+                        raise _WebSocketError(1002)
+                    opcode = opcode or op
+                    size += len(payload)
+                    if size > self.max_size:
+                        raise _WebSocketError(1009)
+                    parts.append(payload)
+                    if fin:
+                        message = b''.join(parts)
+                        if opcode == 1:
+                            try:
+                                message = message.decode('utf-8')
+                            except UnicodeDecodeError:
+                                raise _WebSocketError(1007)
+                        return message
+                except _WebSocketError as e:
+                    self._send(8, struct.pack('!H', e.code))
+                    self.closed = True
+                except (EOFError, IOError, OSError):  # includes socket timeouts (idle_timeout)
+                    self.close_code, self.closed = self.close_code or 1006, True
+        return None
+
+    def send(self, message):
+        """Send a str as a text message, or bytes as a binary one."""
+        if self.closed or self._close_sent:
+            raise IOError("WebSocket is closed")
+        if isinstance(message, _text):
+            self._send(1, message.encode('utf-8'))
+        else:
+            self._send(2, bytes(message))
+
+    def ping(self, data=b''):
+        """Send a ping; the peer's pong is handled (and dropped) by receive()."""
+        self._send(9, data)
+
+    def close(self, code=1000, reason=''):
+        """Send a close frame (once), and wait up to close_timeout for the peer's close frame.
+        Returns without waiting if another thread is in receive(); it will see the reply."""
+        import struct
+        try:
+            if self.close_code != 1006:
+                self._send(8, struct.pack('!H', code) + reason.encode('utf-8'))
+            if not self.closed and self._recv_lock.acquire(False):
+                try:
+                    self.sock.settimeout(self.close_timeout)
+                    while self.receive() is not None:  # messages sent before the peer saw our close
+                        pass
+                finally:
+                    self._recv_lock.release()
+        except (IOError, OSError):
+            pass
+        self.closed = True
+
+    def _read(self, n):
+        data = self.rfile.read(n)
+        if len(data) < n:
+            raise EOFError
+        return data
+
+    def _read_frame(self):
+        """Read one frame; returns (fin, opcode, payload)."""
+        import struct
+        b0, b1 = bytearray(self._read(2))
+        if b0 & 0x70 or not b1 & 0x80:  # reserved bits set, or a client frame that isn't masked
+            raise _WebSocketError(1002)
+        length = b1 & 0x7f
+        if length == 126:
+            length = struct.unpack('!H', self._read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self._read(8))[0]
+        if length > self.max_size:
+            raise _WebSocketError(1009)
+        mask = self._read(4)
+        return b0 & 0x80, b0 & 0x0f, _unmask(self._read(length), mask)
+
+    def _send(self, opcode, payload):
+        import struct
+        n = len(payload)
+        if n < 126:
+            header = struct.pack('!BB', 0x80 | opcode, n)
+        elif n < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, n)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, n)
+        with self._send_lock:
+            if self._close_sent:  # nothing may follow a close frame
+                return
+            self._close_sent = opcode == 8
+            self.sock.sendall(header + payload)
+
+
+_HOP_BY_HOP = frozenset(('connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+                         'te', 'trailer', 'trailers', 'transfer-encoding', 'upgrade'))
+
+
+def _strip_hop_by_hop(headers):
+    """Drop headers that only apply to one connection, including any listed in Connection."""
+    drop = _HOP_BY_HOP.union(t.strip().lower() for k, v in headers if k.lower() == 'connection'
+                             for t in v.split(','))
+    return [(k, v) for k, v in headers if k.lower() not in drop]
+
+
+class _HttpPool(object):
+    """Keep-alive connections to one upstream host: at most `size` open at once, idle or in use."""
+    pools = {}
+    pools_lock = threading.Lock()
+
+    def __init__(self, scheme, netloc, size):
+        if sys.version_info[0] == 2: import httplib as client  # pylint: disable=E0401
+        else: import http.client as client
+        self.client = client
+        self.conn_class = client.HTTPSConnection if scheme == 'https' else client.HTTPConnection
+        self.netloc, self.size = netloc, size
+        self.idle = []
+        self.open = 0  # idle connections, plus those lent out
+        self.changed = threading.Condition(threading.Lock())
+
+    @classmethod
+    def get(cls, scheme, netloc, size=None):
+        """The pool for a host; size, if given, replaces its current size."""
+        pool = cls.pools.get((scheme, netloc))
+        if pool is None:
+            with cls.pools_lock:
+                pool = cls.pools.setdefault((scheme, netloc), cls(scheme, netloc, size or 8))
+        if size and size != pool.size:
+            with pool.changed:
+                pool.size = size  # connections over a smaller size are closed as they come back
+                pool.changed.notify_all()
+        return pool
+
+    def acquire(self, timeout):
+        """Returns (connection, reused); raises a 503 if none frees up within timeout seconds."""
+        end = _clock() + timeout
+        with self.changed:
+            while not self.idle and self.open >= self.size:
+                remaining = end - _clock()
+                if remaining <= 0:
+                    raise HttpError(503, headers={'Retry-After': '1'})
+                self.changed.wait(remaining)
+            conn = self.idle.pop() if self.idle else None
+            if conn is None:
+                self.open += 1
+        if conn is None:
+            return self.conn_class(self.netloc, timeout=timeout), False
+        conn.timeout = timeout
+        if conn.sock: conn.sock.settimeout(timeout)
+        return conn, True
+
+    def release(self, conn):
+        """Return a connection that can be reused."""
+        with self.changed:
+            if self.open <= self.size:
+                self.idle.append(conn)
+                return self.changed.notify()
+        self.discard(conn)
+
+    def discard(self, conn):
+        """Close a connection, freeing its place."""
+        conn.close()
+        with self.changed:
+            self.open -= 1
+            self.changed.notify()
+
+
+class _UpstreamBody(object):
+    """Streams an upstream response body; the connection goes back to the pool once it's drained."""
+    def __init__(self, pool, conn, resp):
+        self.pool, self.conn, self.resp = pool, conn, resp
+
+    def __iter__(self):
+        read = getattr(self.resp, 'read1', self.resp.read)  # read1: don't wait to fill the chunk
+        chunk = read(FileResponse.chunk_size)
+        while chunk:
+            yield chunk
+            chunk = read(FileResponse.chunk_size)
+        self.resp.read()  # read1 doesn't mark the response closed at the end of a sized body
+        self.close()
+
+    def close(self):
+        conn, self.conn = self.conn, None
+        if conn is None: return
+        if self.resp.isclosed() and not self.resp.will_close:  # fully read; safe to reuse
+            self.pool.release(conn)
+        else:
+            self.pool.discard(conn)
+
+    def __del__(self):  # a Response dropped without being sent still gives back its connection
+        self.close()
+
+    @staticmethod
+    def close_all(bodies):
+        for body in bodies:
+            body.close()
+
+
+class Session(dict):
+    """A dict of session data that notes whether it has been modified."""
+    __slots__ = ('sid', 'dirty')
+
+    def __init__(self, sid=None, data=()):
+        dict.__init__(self, data)
+        self.sid = sid  # None until the session is first saved
+        self.dirty = False  # set it yourself after mutating a value in place
+
+    def __setitem__(self, key, value):
+        self.dirty = True
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.dirty = True
+        dict.__delitem__(self, key)
+
+    def clear(self):
+        self.dirty = True
+        dict.clear(self)
+
+    def pop(self, *args):
+        self.dirty = True
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self.dirty = True
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        if key not in self: self.dirty = True
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        self.dirty = True
+        dict.update(self, *args, **kwargs)
+
+
+class Sessions(object):
+    """Signed-cookie sessions, with the data held server-side in a store."""
+    def __init__(self, secret, store=None, cookie_name='session', cookie_path='/', secure=False,
+                 max_age=None):
+        self.secret = secret.encode('utf-8') if not isinstance(secret, bytes) else secret
+        self.store = store if store is not None else MemorySessionStore()
+        self.cookie_name, self.cookie_path, self.secure, self.max_age = (
+            cookie_name, cookie_path, secure, max_age)
+
+    def _sign(self, sid):
+        import base64, hashlib, hmac
+        digest = hmac.new(self.secret, sid.encode('ascii'), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+    def _unsign(self, value):
+        """Return the session ID from a cookie value, or None if the signature doesn't match."""
+        import hmac
+        sid, _, sig = value.rpartition('.')
+        try:
+            return sid if sid and hmac.compare_digest(sig, self._sign(sid)) else None
+        except (TypeError, UnicodeError):  # non-ASCII: not something _sign() made
+            return None
+
+    def _cookie(self, value, max_age):
+        cookie = "%s=%s; Path=%s; HttpOnly; SameSite=Lax" % (self.cookie_name, value, self.cookie_path)
+        if max_age is not None: cookie += "; Max-Age=%i" % (max_age)
+        return cookie + "; Secure" if self.secure else cookie
+
+    def load(self, request):
+        for part in request.environ.get('HTTP_COOKIE', '').split(';'):
+            name, _, value = part.strip().partition('=')
+            if name == self.cookie_name:
+                sid = self._unsign(value)
+                data = self.store.load(sid) if sid else None
+                if data is not None:
+                    return Session(sid, data)
+        return Session()
+
+    def save(self, session, response):
+        """Write a modified session to the store, setting or expiring the cookie as needed."""
+        if not session.dirty:
+            return
+        if not session:  # emptied: forget it entirely
+            if session.sid:
+                self.store.delete(session.sid)
+                response.headers.add_header('Set-Cookie', self._cookie('', 0))
+            return
+        if session.sid is None:
+            import base64
+            session.sid = base64.urlsafe_b64encode(os.urandom(18)).decode('ascii')
+            response.headers.add_header(
+                'Set-Cookie', self._cookie(session.sid + '.' + self._sign(session.sid), self.max_age))
+        self.store.save(session.sid, dict(session))
+        session.dirty = False
+
+
+class MemorySessionStore(object):
+    """Thread-safe in-process session store with LRU and idle-TTL eviction."""
+    def __init__(self, max_entries=10000, ttl=3600):
+        import collections
+        self.max_entries, self.ttl = max_entries, ttl
+        self.entries = collections.OrderedDict()  # sid -> (expires, data), least recently used first
+        self.lock = threading.Lock()
+
+    def load(self, sid):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(sid, None)
+            if entry is None or entry[0] < now:
+                return None
+            self.entries[sid] = (now + self.ttl, entry[1])  # re-insert as most recently used
+            return dict(entry[1])  # a copy, so concurrent requests don't share one dict
+
+    def save(self, sid, data):
+        with self.lock:
+            self.entries.pop(sid, None)
+            self.entries[sid] = (time.time() + self.ttl, data)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, sid):
+        with self.lock:
+            self.entries.pop(sid, None)
+
+
+class SqliteSessionStore(object):
+    """Session store in a sqlite database, shareable between processes. Data must be JSON-able.
+
+    Sessions expire `ttl` seconds after they were last written."""
+    def __init__(self, path, ttl=3600, timeout=5.0):
+        self.path, self.ttl, self.timeout = path, ttl, timeout
+        self.local = threading.local()  # one connection per thread
+        self._db().execute("CREATE TABLE IF NOT EXISTS sessions "
+                           "(sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)")
+
+    def _db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            import sqlite3
+            db = self.local.db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def load(self, sid):
+        import json
+        row = self._db().execute("SELECT data FROM sessions WHERE sid = ? AND expires >= ?",
+                                 (sid, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, sid, data):
+        import json
+        now = time.time()
+        db = self._db()
+        db.execute("INSERT OR REPLACE INTO sessions (sid, data, expires) VALUES (?, ?, ?)",
+                   (sid, json.dumps(data), now + self.ttl))
+        db.execute("DELETE FROM sessions WHERE expires < ?", (now,))
+
+    def delete(self, sid):
+        self._db().execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+
+class SharedCache(object):
+    """A fixed-size bytes cache in shared memory, usable from every process on the host that opens
+    it by the same name. POSIX only (writers lock with fcntl).
+
+    The table is `slots` slots of `slot_size` bytes, grouped into buckets of `ways`; a key can only
+    live in its bucket, and a full bucket evicts its least recently read entry. Reads take no locks:
+    each slot has a version counter that writers make odd while they're writing, so a reader that
+    sees it change retries. Writers lock one of `stripes` stripes, per thread and per process."""
+    MAGIC = b'TAFCACHE'
+    HEADER = 64  # MAGIC, slots, slot_size, ways
+    SLOT = '=QQddII'  # version, key hash (0: empty), expires (0: never), last read, key len, value len
+    SLOT_HEADER = 40
+
+    def __init__(self, name='tinyaf-cache', slots=8192, slot_size=1024, ways=8, stripes=64):
+        import struct, tempfile
+        from multiprocessing import shared_memory
+        if slots % ways or slot_size <= self.SLOT_HEADER:
+            raise ValueError("slots must be a multiple of ways, and slot_size more than %i" % self.SLOT_HEADER)
+        self.name, self.slots, self.slot_size, self.ways = name, slots, slot_size, ways
+        self.buckets = slots // ways
+        self.struct = struct
+        size = self.HEADER + slots * slot_size
+        try:
+            self.shm, created = self._open(shared_memory, name, True, size), True
+        except FileExistsError:
+            self.shm, created = self._open(shared_memory, name, False, size), False
+        self.buf = self.shm.buf
+        if created:
+            struct.pack_into('=QQQ', self.buf, 8, slots, slot_size, ways)
+            self.buf[:8] = self.MAGIC  # last, so other processes see a complete header
+        else:
+            deadline = _clock() + 1
+            while bytes(self.buf[:8]) != self.MAGIC and _clock() < deadline:
+                time.sleep(0.001)  # its creator is still writing the header
+            if struct.unpack_from('=QQQ', self.buf, 8) != (slots, slot_size, ways):
+                self.close()
+                raise ValueError("shared cache %r exists with a different size or layout" % (name))
+        self.stripes = [threading.Lock() for _ in range(stripes)]
+        self.lockfile = open(os.path.join(tempfile.gettempdir(), name + '.lock'), 'a+b')
+        self.hits = self.misses = self.sets = self.evictions = self.rejected = 0  # this process only
+
+    @staticmethod
+    def _open(shared_memory, name, create, size):
+        try:  # the cache outlives the process that created it, until unlink()
+            return shared_memory.SharedMemory(name, create, size, track=False)
+        except TypeError:  # python < 3.13 has no track=; untrack it by hand
+            shm = shared_memory.SharedMemory(name, create, size)
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')  # pylint: disable=W0212
+            shm._tinyaf_untracked = True
+            return shm
+
+    def _find(self, key):
+        import hashlib
+        key = key.encode('utf-8') if isinstance(key, _text) else key
+        h = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+        first = self.HEADER + (h % self.buckets) * self.ways * self.slot_size
+        return key, h | 1, range(first, first + self.ways * self.slot_size, self.slot_size)  # 0 is "empty"
+
+    def get(self, key, default=None):
+        """The value stored for key, or default if it's missing or has expired."""
+        unpack_from, buf = self.struct.unpack_from, self.buf
+        key, h, offsets = self._find(key)
+        for off in offsets:
+            for _ in range(100):  # retries while a writer is busy with this slot
+                version, sh, expires, _, klen, vlen = unpack_from(self.SLOT, buf, off)
+                if version & 1:
+                    continue
+                if sh != h:
+                    break
+                start = off + self.SLOT_HEADER
+                data = bytes(buf[start:start + klen + vlen])
+                if unpack_from('=Q', buf, off)[0] != version:
+                    continue  # rewritten while we were copying it
+                if data[:klen] != key:
+                    break
+                now = time.time()
+                if expires and expires < now:
+                    self.misses += 1
+                    return default
+                self.struct.pack_into('=d', buf, off + 24, now)  # a hint for eviction; races don't matter
+                self.hits += 1
+                return data[klen:]
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        """Store bytes under key, for ttl seconds (or until evicted). Returns False if the key and
+        value don't fit in a slot."""
+        key, h, offsets = self._find(key)
+        value = bytes(value)
+        if self.SLOT_HEADER + len(key) + len(value) > self.slot_size:
+            self.rejected += 1
+            return False
+        now = time.time()
+        stripe = self._acquire(offsets[0])
+        try:
+            unpack_from, buf = self.struct.unpack_from, self.buf
+            target, oldest = None, None
+            for off in offsets:
+                _, sh, expires, atime, klen, _ = unpack_from(self.SLOT, buf, off)
+                start = off + self.SLOT_HEADER
+                if sh == h and bytes(buf[start:start + klen]) == key:
+                    target = off
+                    break
+                if target is None and (sh == 0 or (expires and expires < now)):
+                    target = off  # free; but keep looking in case the key is further on
+                if oldest is None or atime < oldest[0]:
+                    oldest = (atime, off)
+            if target is None:
+                target = oldest[1]
+                self.evictions += 1
+            self._write(target, h, now + ttl if ttl else 0.0, now, key, value)
+        finally:
+            self._release(stripe)
+        self.sets += 1
+        return True
+
+    def delete(self, key):
+        key, h, offsets = self._find(key)
+        stripe = self._acquire(offsets[0])
+        try:
+            for off in offsets:
+                _, sh, _, _, klen, _ = self.struct.unpack_from(self.SLOT, self.buf, off)
+                start = off + self.SLOT_HEADER
+                if sh == h and bytes(self.buf[start:start + klen]) == key:
+                    self._write(off, 0, 0.0, 0.0, b'', b'')
+        finally:
+            self._release(stripe)
+
+    def _write(self, off, h, expires, atime, key, value):
+        """Rewrite a slot; the caller holds its stripe lock."""
+        version = self.struct.unpack_from('=Q', self.buf, off)[0]
+        self.struct.pack_into('=Q', self.buf, off, version + 1)  # odd: readers stay out
+        start = off + self.SLOT_HEADER
+        self.buf[start:start + len(key) + len(value)] = key + value
+        self.struct.pack_into(self.SLOT, self.buf, off, version + 1, h, expires, atime, len(key), len(value))
+        self.struct.pack_into('=Q', self.buf, off, version + 2)
+
+    def _acquire(self, bucket_offset):
+        """Lock the stripe a bucket belongs to, against other threads and other processes."""
+        import fcntl
+        stripe = (bucket_offset // (self.ways * self.slot_size)) % len(self.stripes)
+        self.stripes[stripe].acquire()  # fcntl locks belong to the whole process
+        fcntl.lockf(self.lockfile, fcntl.LOCK_EX, 1, stripe)
+        return stripe
+
+    def _release(self, stripe):
+        import fcntl
+        fcntl.lockf(self.lockfile, fcntl.LOCK_UN, 1, stripe)
+        self.stripes[stripe].release()
+
+    def stats(self):
+        """Counters for this process's use of the cache."""
+        return dict(hits=self.hits, misses=self.misses, sets=self.sets, evictions=self.evictions,
+                    rejected=self.rejected)
+
+    def close(self):
+        """Detach this process; the cache itself stays until unlink()."""
+        self.buf = None
+        self.shm.close()
+        if hasattr(self, 'lockfile'): self.lockfile.close()
+
+    def unlink(self):
+        """Destroy the shared memory (processes that have it open keep their mapping)."""
+        if getattr(self.shm, '_tinyaf_untracked', False):  # unlink() untracks it again
+            from multiprocessing import resource_tracker
+            resource_tracker.register(self.shm._name, 'shared_memory')  # pylint: disable=W0212
+        self.shm.unlink()
+
+
+class AccessLog(object):
+    """Buffered access log: requests are queued, and formatted and written by a background thread."""
+    def __init__(self, target=None, queue_size=10000, batch_size=256, json_lines=False):
+        if sys.version_info[0] == 2: import Queue as queue  # pylint: disable=E0401
+        else: import queue
+        if target is None: target = sys.stderr
+        self.stream = open(target, 'a') if isinstance(target, (str, _text)) else target
+        self.records = queue.Queue(queue_size)
+        self.full, self.empty = queue.Full, queue.Empty
+        self.batch_size = batch_size
+        self.json_lines = json_lines
+        self.dropped = 0  # records thrown away because the queue was full
+        self._reported = 0
+        writer = threading.Thread(target=self._write_batches, name="tinyaf-access-log")
+        writer.daemon = True
+        writer.start()
+
+    def log(self, request, status, sent, duration):
+        """Queue one request's record; never blocks, and drops the record if the queue is full."""
+        environ = request.environ
+        route = request._route
+        self._put(('access', time.time(), environ.get('REMOTE_ADDR', '-'), request.method,
+                   environ.get('SCRIPT_NAME', '') + request.path, environ.get('QUERY_STRING', ''),
+                   environ.get('SERVER_PROTOCOL', '-'), route and route['path'], status, sent, duration))
+
+    def error(self, exc_info):
+        """Queue a traceback; it's formatted on the writer thread."""
+        self._put(('error', exc_info))
+
+    def _put(self, item):
+        try:
+            self.records.put_nowait(item)
+        except self.full:
+            self.dropped += 1  # not exact under contention; that's fine for a counter like this
+
+    def format(self, record):
+        """One log line for a record dict; override for a different layout."""
+        if self.json_lines:
+            import json
+            return json.dumps(record, sort_keys=True) + "\n"
+        return '%s - - [%s] "%s %s%s %s" %i %i %.6f %s\n' % (
+            record['remote_addr'], time.strftime('%d/%b/%Y:%H:%M:%S +0000', time.gmtime(record['time'])),
+            record['method'], record['path'], record['query'] and '?' + record['query'], record['protocol'],
+            record['status'], record['bytes'], record['duration'], record['route'] or '-')
+
+    def _format(self, item):
+        if item[0] == 'error':
+            import traceback
+            return ''.join(traceback.format_exception(*item[1]))
+        keys = ('time', 'remote_addr', 'method', 'path', 'query', 'protocol', 'route', 'status', 'bytes',
+                'duration')
+        return self.format(dict(zip(keys, item[1:])))
+
+    def _write_batches(self):
+        while True:
+            batch = [self.records.get()]  # wait for one, then take whatever else is already queued
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.records.get_nowait())
+            except self.empty:
+                pass
+            try:
+                lines = [self._format(item) for item in batch]
+                dropped = self.dropped
+                if dropped != self._reported:
+                    lines.append("access log: %i records dropped (queue full)\n" % (dropped - self._reported))
+                    self._reported = dropped
+                self.stream.write(''.join(lines))
+                self.stream.flush()
+            except Exception:
+                pass  # a log that can't be written mustn't take the writer thread down
+            for _ in batch:
+                self.records.task_done()
+
+    def flush(self, timeout=None):
+        """Wait until every queued record has been written. Returns False if timeout ran out first."""
+        return _drain(self.records, timeout)
+
+
+class _AdmissionGate(object):
+    """Caps concurrent handler calls for a route, with a bounded wait queue; the rest get a 503."""
+    def __init__(self, max_concurrency, queue=0, queue_timeout=None, retry_after=1):
+        self.slots = threading.Semaphore(max_concurrency)
+        self.limit = max_concurrency + queue  # most requests allowed in, running or waiting
+        self.queue_timeout = queue_timeout if queue else 0
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.admitted = self.in_flight = self.rejected = 0
+
+    def enter(self):
+        with self.lock:
+            if self.admitted < self.limit:
+                self.admitted += 1
+            else:
+                self.rejected += 1
+                raise self.overloaded()
+        if self.queue_timeout == 0: acquired = self.slots.acquire(False)
+        else: acquired = self.slots.acquire(True, self.queue_timeout)
+        if not acquired:
+            with self.lock:
+                self.admitted -= 1
+                self.rejected += 1
+            raise self.overloaded()
+        with self.lock:
+            self.in_flight += 1
+
+    def exit(self):
+        self.slots.release()
+        with self.lock:
+            self.in_flight -= 1
+            self.admitted -= 1
+
+    def overloaded(self):
+        return HttpError(503, headers={'Retry-After': str(self.retry_after)})
+
+    def stats(self):
+        with self.lock:
+            return dict(in_flight=self.in_flight, queued=self.admitted - self.in_flight,
+                        rejected=self.rejected)
+
+
+class _Task(object):
+    """A call to run on a _WorkerPool, and its outcome."""
+    def __init__(self, fn, args):
+        self.fn, self.args = fn, args
+        self.done = threading.Event()
+        self.value = self.error = None
+
+    def run(self):
+        try:
+            self.value = self.fn(*self.args)
+        except BaseException as e:
+            self.error = e
+        self.done.set()
+
+    def result(self):
+        """Wait for the call, then return its result (or raise its exception)."""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class _WorkerPool(object):
+    """Daemon worker threads, started on demand up to max_workers. Daemon threads matter here:
+    a call that never returns mustn't hold up interpreter exit."""
+    def __init__(self, max_workers, max_queue=0):
+        if sys.version_info[0] == 2: import Queue as queue  # pylint: disable=E0401
+        else: import queue
+        self.tasks = queue.Queue(max_queue)
+        self.full = queue.Full
+        self.max_workers = max_workers
+        self.workers = 0
+        self.idle = threading.Semaphore(0)  # one count per worker waiting for a task
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        """Queue fn(*args), and return its _Task; or None if a bounded queue is full."""
+        task = _Task(fn, args)
+        try:
+            self.tasks.put_nowait(task)
+        except self.full:
+            return None
+        if not self.idle.acquire(False):
+            with self.lock:
+                if self.workers < self.max_workers:
+                    self.workers += 1
+                    worker = threading.Thread(target=self._work, name="tinyaf-worker")
+                    worker.daemon = True
+                    worker.start()
+        return task
+
+    def _work(self):
+        while True:
+            self.tasks.get().run()
+            self.tasks.task_done()
+            self.idle.release()
+
+    def drain(self, timeout=None):
+        """Wait until every queued task has run. Returns False if timeout ran out first."""
+        return _drain(self.tasks, timeout)
+
+
+def _drain(tasks, timeout=None):
+    """Wait until every item put on a queue.Queue has been marked done, or until timeout."""
+    end = None if timeout is None else _clock() + timeout
+    with tasks.all_tasks_done:
+        while tasks.unfinished_tasks:
+            if end is not None and end <= _clock():
+                return False
+            tasks.all_tasks_done.wait(None if end is None else end - _clock())
+    return True
+
+
+class _ClosingIterator(object):
+    """Wraps a WSGI iterable to make a callback once the server has closed it."""
+    def __init__(self, iterable, callback, *args):
+        self.iterable, self.callback, self.args = iterable, callback, args
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'): self.iterable.close()
+        finally:
+            self.callback(*self.args)
+
+
+class _BatchEndpoint(object):
+    """Route handler that runs a JSON list of sub-requests through request.app."""
+    def __init__(self, max_requests=50, workers=0):
+        self.max_requests = max_requests
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def __call__(self, request, response):
+        import json
+        if request.environ.get('tinyaf.batch'):  # would wait on the pool its own caller occupies
+            raise HttpError(400, "Batch requests cannot be nested")
+        try:
+            length = int(request.environ.get('CONTENT_LENGTH') or 0)
+            entries = json.loads(request.environ['wsgi.input'].read(length).decode('utf-8'))
+        except (ValueError, KeyError):
+            raise HttpError(400, "Batch body must be a JSON list of requests")
+        if not isinstance(entries, list) or not all(isinstance(e, dict) for e in entries):
+            raise HttpError(400, "Batch body must be a JSON list of requests")
+        if len(entries) > self.max_requests:
+            raise HttpError(413, "At most %i requests per batch" % (self.max_requests))
+        environs = [self.environ(request.environ, entry) for entry in entries]
+        for environ in environs:
+            environ['tinyaf.deadline'] = request.deadline
+        if self.workers and len(environs) > 1:
+            if self.pool is None:
+                with self.lock:
+                    if self.pool is None:
+                        self.pool = _WorkerPool(self.workers)
+            tasks = [self.pool.submit(self.run, request.app, env) for env in environs]
+            response.write([task.result() for task in tasks])
+        else:
+            response.write([self.run(request.app, env) for env in environs])
+        return response
+
+    @staticmethod
+    def environ(outer, entry):
+        """Synthesize a sub-request's environ. Headers the entry doesn't set (cookies,
+        authorization) are inherited from the batch request itself."""
+        import io, json
+        path = entry.get('path')
+        if not isinstance(path, _text) or not path.startswith('/'):
+            raise HttpError(400, "Every batch request needs an absolute path")
+        path, _, query = path.partition('?')
+        body = entry.get('body')
+        headers = dict((k.lower(), v) for k, v in (entry.get('headers') or {}).items())
+        if body is None:
+            body = b''
+        elif isinstance(body, _text):
+            body = body.encode('utf-8')
+        else:  # a JSON value; sent as JSON
+            body = json.dumps(body).encode('utf-8')
+            headers.setdefault('content-type', 'application/json')
+        environ = dict((k, v) for k, v in outer.items()  # server hooks like tinyaf.upgrade stay behind
+                       if k not in ('CONTENT_TYPE', 'CONTENT_LENGTH') and not k.startswith('tinyaf.'))
+        environ.update({'REQUEST_METHOD': str(entry.get('method') or 'GET').upper(),
+                        'PATH_INFO': path, 'QUERY_STRING': query,
+                        'CONTENT_LENGTH': str(len(body)) if body else '', 'wsgi.input': io.BytesIO(body),
+                        'tinyaf.batch': True})
+        for name, value in headers.items():
+            key = name.upper().replace('-', '_')
+            environ[key if key in ('CONTENT_TYPE', 'CONTENT_LENGTH') else 'HTTP_' + key] = str(value)
+        return environ
+
+    @staticmethod
+    def run(app, environ):
+        """Dispatch one sub-request through the app; returns its JSON-ready result."""
+        import base64
+        started = []
+        out = app(environ, lambda status, headers, exc_info=None: started.append((status, headers)))
+        try:
+            body = b''.join(out)
+        finally:
+            if hasattr(out, 'close'): out.close()
+        status, headers = started[-1]
+        result = {'status': int(status.split(' ', 1)[0]), 'headers': [list(h) for h in headers]}
+        try:
+            result['body'] = body.decode('utf-8')
+        except UnicodeDecodeError:
+            result['body'], result['encoding'] = base64.b64encode(body).decode('ascii'), 'base64'
+        return result
+
+
+class _ContinueInput(object):
+    """wsgi.input for a request that sent `Expect: 100-continue`. The interim 100 response is sent
+    when the application first reads the body, so a request it rejects (404, 405, 413) without
+    reading is never uploaded."""
+    def __init__(self, rfile, wfile):
+        self.rfile, self.wfile = rfile, wfile
+
+    def _continue(self):
+        if self.wfile is not None:
+            self.wfile.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            self.wfile.flush()
+            self.wfile = None
+
+    def read(self, *args):
+        self._continue()
+        return self.rfile.read(*args)
+
+    def readline(self, *args):
+        self._continue()
+        return self.rfile.readline(*args)
+
+    def readlines(self, *args):
+        self._continue()
+        return self.rfile.readlines(*args)
+
+    def __iter__(self):
+        self._continue()
+        return iter(self.rfile)
+
+
+def _server_request_handler():
+    """wsgiref's request handler, plus environ['tinyaf.upgrade']: a callable that hands the
+    connection's (socket, rfile) to the application, after which the server writes nothing more."""
+    import wsgiref.simple_server
+
+    class ServerHandler(wsgiref.simple_server.ServerHandler):
+        def finish_response(self):
+            if self.request_handler.upgraded:
+                self.close()  # still closes the app's iterable and logs the request
+            else:
+                wsgiref.simple_server.ServerHandler.finish_response(self)
+
+    class RequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+        upgraded = False
+
+        def get_environ(self):
+            environ = wsgiref.simple_server.WSGIRequestHandler.get_environ(self)
+            environ['tinyaf.upgrade'] = self.upgrade
+            return environ
+
+        def log_request(self, *args):
+            if getattr(self.server.get_app(), 'access_log', None) is None:  # else the app logs it
+                wsgiref.simple_server.WSGIRequestHandler.log_request(self, *args)
+
+        def upgrade(self):
+            self.upgraded = True
+            return self.connection, self.rfile
+
+        def handle(self):  # as in wsgiref, but with the ServerHandler above
+            self.raw_requestline = self.rfile.readline(65537)
+            if len(self.raw_requestline) > 65536:
+                self.requestline = self.request_version = self.command = ''
+                self.send_error(414)
+                return
+            if not self.parse_request():
+                return
+            stdin = self.rfile
+            if self.request_version == 'HTTP/1.1' and self.headers.get('Expect', '').lower() == '100-continue':
+                stdin = _ContinueInput(self.rfile, self.wfile)
+            handler = ServerHandler(stdin, self.wfile, self.get_stderr(), self.get_environ(),
+                                    multithread=False)
+            handler.request_handler = self
+            handler.run(self.server.get_app())
+
+    return RequestHandler
+
+
+class _LoggedIterator(object):
+    """Wraps a WSGI iterable to count the bytes sent, and log the request once the server closes it."""
+    def __init__(self, iterable, access_log, request, status, start):
+        self.iterable, self.access_log, self.request, self.status, self.start = (
+            iterable, access_log, request, status, start)
+        self.sent = 0
+
+    def __iter__(self):
+        for chunk in self.iterable:
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'): self.iterable.close()
+        finally:
+            self.access_log.log(self.request, self.status, self.sent, _clock() - self.start)
+
+
+def _is_coroutine_function(fn):
+    """True for `async def` functions and methods; checked without importing asyncio or inspect."""
+    code = getattr(getattr(fn, '__func__', fn), '__code__', None)
+    return bool(getattr(code, 'co_flags', 0) & 0x80)  # CO_COROUTINE
+
+
+class _LoopThread(object):
+    """A long-lived asyncio event loop on a daemon thread, shared by every app in the process."""
+    instance = None
+    lock = threading.Lock()
+
+    def __init__(self):
+        import asyncio
+        self.asyncio = asyncio
+        self.pid = os.getpid()
+        self.loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self.loop.run_forever, name="tinyaf-asyncio")
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def get(cls):
+        loop_thread = cls.instance
+        if loop_thread is None or loop_thread.pid != os.getpid():  # a forked child needs its own
+            with cls.lock:
+                if cls.instance is None or cls.instance.pid != os.getpid():
+                    cls.instance = cls()
+                loop_thread = cls.instance
+        return loop_thread
+
+    def submit(self, coro):
+        """Schedule a coroutine on the loop; returns a concurrent.futures.Future."""
+        return self.asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+def _carry_deferred(old, new):
+    """Move calls deferred on a response that's been replaced (by a returned Response, or a raised
+    HttpError) onto its replacement, ahead of the replacement's own."""
+    if old is not new and old._deferred:
+        new._deferred = old._deferred + (new._deferred or [])
+        old._deferred = None
+    return new
+
+
+def _materialize(fn, request, response):
+    """Run a handler, then finalize and read its response all the way. Returns (code, status,
+    headers, body, deferred calls), so the response can be copied or sent to another process."""
+    result = fn(request, response)
+    if result:  # as in App._get_response
+        if isinstance(result, Response): response = _carry_deferred(response, result)
+        else: response.write(result)
+    headers = list(response._finalize_headers(request.environ))
+    instance = response.response_instance
+    try:
+        body = b''.join(instance)
+    finally:
+        if hasattr(instance, 'close'): instance.close()
+    return response.code, response.status, headers, body, response._deferred
+
+
+def _run_in_process(fn, environ, body, url_vars, response_class):
+    """Runs in a worker process for executor='process' routes: rebuild the request, run the handler,
+    and return its response as plain data. Deferred calls go back with it, to run in the parent's
+    background pool; any that can't be pickled run on a thread here once the reply is on its way."""
+    import io, pickle
+    environ['wsgi.input'] = io.BytesIO(body)
+    request = Request(environ)
+    request.vars = url_vars
+    try:
+        code, status, headers, body, deferred = _materialize(fn, request, response_class())
+    except HttpError as e:  # an HttpError doesn't survive pickling, so send what's needed to rebuild it
+        return 'error', (e.code, list(e.headers.items()), [c for c in e.content if isinstance(c, str)])
+    except Exception:
+        import traceback
+        return 'exception', traceback.format_exc()
+    sent = []
+    for call in deferred or ():
+        try:
+            pickle.dumps(call)
+            sent.append(call)
+        except Exception:
+            threading.Thread(target=App._run_background, args=call, name="tinyaf-deferred").start()
+    return 'ok', (code, status, headers, body, sent)
+
+
+def _literal_prefix(pattern):
+    """For a route regex: (text every match starts with, whether that text is the whole match).
+    Conservative: anything it can't read ends the prefix, and alternation anywhere gives ''."""
+    if '|' in pattern.replace('\\\\', '').replace('\\|', ''):
+        return '', False
+    prefix, i = [], 1 if pattern.startswith('^') else 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\' and i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+            prefix.append(pattern[i + 1])  # an escaped literal
+            i += 2
+        elif c in '*?{':  # the character before it is optional
+            return ''.join(prefix[:-1]), False
+        elif c == '$' and i == len(pattern) - 1:
+            return ''.join(prefix), True
+        elif c in '\\.^$[]()+':
+            break
+        else:
+            prefix.append(c)
+            i += 1
+    return ''.join(prefix), False
+
+
+def _may_overlap(a, b):
+    """Could some request match both routes? a and b are ((prefix, exact), methods)."""
+    (pa, exact_a), methods_a = a
+    (pb, exact_b), methods_b = b
+    if methods_a and methods_b and not set(methods_a).intersection(methods_b):
+        return False  # lookup skips a route whose methods don't match, so their order can't matter
+    if exact_a and exact_b:
+        return pa == pb
+    if exact_a:
+        return pa.startswith(pb)
+    if exact_b:
+        return pb.startswith(pa)
+    return pa.startswith(pb) or pb.startswith(pa)
+
 
 class App(Router):
     response_class = StringResponse
     tracebacks_to_http = False
     tracebacks_to_stderr = True
+    sessions = None  # set to a Sessions instance to enable request.session
+    access_log = None  # set to an AccessLog instance to log requests (and tracebacks) through it
+    request_timeout = None  # seconds; app-wide default for the route `timeout` option
+    max_body_size = None  # bytes; app-wide default for the route `max_body` option
+    timeout_workers = 64  # most handlers running under a deadline at once
+    timeout_queue = 1000  # most handlers waiting for one of those; more are answered 503
+    process_workers = None  # processes for executor='process' routes (default: one per CPU)
+    background_workers = 4  # threads running response.defer() work
+    background_queue = 1000  # most deferred calls waiting to run
+    background_overflow = 'drop'  # when that queue is full: 'drop' the call, or run it 'inline'
+    adaptive_routing = False  # try busy routes first, where that can't change which route matches
+    adaptive_interval = 1000  # routed requests between reorderings
 
     def __init__(self, router=None):
-        self.routes = []
+        # Route state is copy-on-write: registration builds new containers and swaps them in with
+        # a single assignment, so request threads never see a table that's being modified.
+        self.routes = ()
         self.errorhandlers = {}
+        self.mounts = {}  # path prefix (no trailing slash) -> WSGI application
+        self.timeouts = 0  # requests answered with a 504 because their deadline passed
+        self._deadline_pool = self._background_pool = self._process_pool = None
+        self.frozen = False
+        self._table = ()  # compiled (pattern.match, methods, route, options) tuples; see _compile()
+        self._base_table = ()  # the same, in registration order
+        self._error_handlers = {}  # code -> handler, from self.errorhandlers
+        self._successors = None  # (base table, for each entry: later entries that must stay after it)
+        self._lookups = 0  # routed requests since the last reordering
+        self._update_lock = threading.Lock()  # writers only; the read path takes no locks
         if router:
-            router.apps.append(self)
-            for d in router.entries:
-                self._router_update(**d)
+            with router._lock:
+                router.apps.append(self)
+                for d in router.entries:
+                    self._router_update(**d)
 
     ### Routing ###########################################
     def _router_update(self, routetype, **kwargs):
-        if routetype == 'route':
-            kwargs['pattern'] = re.compile(self._route_escape(kwargs['path']))
-            self.routes.append(kwargs.copy())
-        elif routetype == 'errorhandler':
-            self.errorhandlers[int(kwargs['code'])] = kwargs.copy()
+        with self._update_lock:
+            if self.frozen:
+                raise RuntimeError("App is frozen; routes and error handlers can't be changed.")
+            if routetype in ('route', 'errorhandler') and _is_coroutine_function(kwargs['handler']):
+                kwargs['handler'] = self._async_handler(kwargs['handler'], routetype == 'route')
+                kwargs['self_timed'] = True
+            if routetype == 'route' and kwargs.get('executor') == 'process':
+                kwargs['handler'] = self._process_handler(kwargs['handler'], kwargs['path'])
+                kwargs['self_timed'] = True
+            elif routetype == 'route' and kwargs.get('executor'):
+                raise ValueError("unknown executor %r; the only one is 'process'" % (kwargs['executor']))
+            if routetype == 'route' and kwargs.get('coalesce'):
+                kwargs['handler'] = self._coalescing_handler(kwargs['handler'], kwargs.get('coalesce_headers', ()),
+                                                             kwargs.get('coalesce_timeout', 30))
+            if routetype == 'route':
+                kwargs['pattern'] = re.compile(self._route_escape(kwargs['path']))
+                kwargs['methods'] = tuple(kwargs['methods']) if kwargs.get('methods') else None
+                if kwargs.get('max_concurrency'):
+                    kwargs['gate'] = _AdmissionGate(kwargs['max_concurrency'], kwargs.get('queue', 0),
+                                                    kwargs.get('queue_timeout'), kwargs.get('retry_after', 1))
+                self.routes = self.routes + (kwargs,)
+            elif routetype == 'errorhandler':
+                errorhandlers = self.errorhandlers.copy()
+                errorhandlers[int(kwargs['code'])] = kwargs
+                self.errorhandlers = errorhandlers
+            elif routetype == 'mount':
+                mounts = self.mounts.copy()
+                mounts[kwargs['prefix']] = kwargs['handler']
+                self.mounts = mounts
+            self._compile()
+
+    def _async_handler(self, fn, timed):
+        """Wrap an `async def` handler so it runs on the shared event loop thread."""
+        def handler(request, response):
+            import concurrent.futures
+            future = _LoopThread.get().submit(fn(request, response))
+            try:
+                return future.result(request.time_remaining() if timed else None)
+            except concurrent.futures.TimeoutError:
+                future.cancel()  # unlike a blocked thread, a coroutine can actually be stopped
+                with self._update_lock:
+                    self.timeouts += 1
+                raise HttpError(504)
+        return handler
+
+    def _process_handler(self, fn, path):
+        """Wrap a handler to run in the app's process pool. The handler is pickled by reference, so
+        it has to be a module-level function; that's checked now rather than on the first request."""
+        import pickle
+        try:
+            pickle.dumps(fn)
+        except Exception as e:
+            raise ValueError("The handler for %s can't run with executor='process': it must be a "
+                             "module-level function, as it's sent to worker processes by name (%s)" % (path, e))
+
+        def handler(request, response):
+            import concurrent.futures
+            environ = request.environ
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            body = environ['wsgi.input'].read(length) if length else b''
+            environ = dict((k, v) for k, v in environ.items() if isinstance(v, str))  # the picklable part
+            future = self._get_process_pool().submit(_run_in_process, fn, environ, body, dict(request.vars),
+                                                      type(response))
+            try:
+                outcome, value = future.result(request.time_remaining())
+            except concurrent.futures.TimeoutError:
+                future.cancel()  # only helps if it hasn't started; a running call is left to finish
+                with self._update_lock:
+                    self.timeouts += 1
+                raise HttpError(504)
+            except (pickle.PicklingError, TypeError, AttributeError) as e:
+                raise TypeError("executor='process' route %s: the request vars or the handler's response "
+                                "couldn't be pickled (%s)" % (path, e))
+            except concurrent.futures.BrokenExecutor:
+                with self._update_lock:
+                    self._process_pool = None  # a worker died; start a fresh pool next time
+                raise
+            if outcome == 'error':
+                code, headers, content = value
+                raise HttpError(code, ''.join(content), headers=headers)
+            if outcome == 'exception':
+                raise RuntimeError("Handler for %s failed in a worker process:\n%s" % (path, value))
+            code, status, headers, body, deferred = value
+            response = Response([body], code, headers, status=status)
+            response._deferred = deferred or None
+            return response
+        return handler
+
+    def _get_process_pool(self):
+        if self._process_pool is None:
+            with self._update_lock:
+                if self._process_pool is None:
+                    import concurrent.futures, multiprocessing
+                    # Not fork: this process already runs threads (workers, the log writer, asyncio)
+                    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                    self._process_pool = concurrent.futures.ProcessPoolExecutor(
+                        self.process_workers, mp_context=multiprocessing.get_context(method))
+        return self._process_pool
+
+    def _coalescing_handler(self, fn, headers, wait):
+        """Wrap a handler so concurrent identical GETs (same path, query string and `headers`) run it
+        once: the first request runs it, and the rest wait up to `wait` seconds for a copy of its
+        finished response."""
+        flights, lock = {}, threading.Lock()  # key -> _Task producing (code, status, headers, body)
+        names = ['HTTP_' + h.upper().replace('-', '_') for h in headers]
+
+        def handler(request, response):
+            if request.method not in ('GET', 'HEAD'):
+                return fn(request, response)
+            environ = request.environ
+            key = (request.method, environ['PATH_INFO'], environ.get('QUERY_STRING', ''),
+                   tuple(environ.get(n) for n in names))
+            with lock:
+                task = flights.get(key)
+                leader = task is None
+                if leader:
+                    task = flights[key] = _Task(_materialize, (fn, request, response))
+            if leader:
+                try:
+                    task.run()
+                finally:
+                    with lock:
+                        del flights[key]
+            elif not task.done.wait(wait if request.deadline is None else request.time_remaining()):
+                with self._update_lock:
+                    self.timeouts += 1
+                raise HttpError(504)
+            # Cookies belong to the leader's client; the other requests get everything else.
+            private = lambda headers: [h for h in headers if h[0].lower() != 'set-cookie']
+            error = task.error
+            if error is not None:
+                if leader:
+                    raise error  # handled (and logged) as usual, once
+                if isinstance(error, HttpError):
+                    raise HttpError(error.code, headers=private(error.headers.items()))
+                raise HttpError(500)
+            code, status, headers_sent, body, deferred = task.value
+            if leader:
+                shared = Response([body], code, headers_sent, status=status)
+                shared._deferred = deferred
+            else:
+                shared = Response([body], code, private(headers_sent), status=status)
+            return shared
+        return handler
+
+    def _compile(self):
+        """Rebuild the flat dispatch table from self.routes and swap it in. Routes that take GET
+        take HEAD too; the body is dropped in __call__. Once frozen, each entry also carries its
+        route's options (see _route_options), so dispatch doesn't look them up per request."""
+        head = lambda m: m + ('HEAD',) if m and 'GET' in m and 'HEAD' not in m else m
+        options = self._route_options if self.frozen else lambda r: None
+        self._table = self._base_table = tuple((r['pattern'].match, head(r['methods']), r, options(r))
+                                               for r in self.routes)
+        self._error_handlers = dict((code, r['handler']) for code, r in self.errorhandlers.items())
+        if self.adaptive_routing:
+            self._reorder()
+
+    def _route_options(self, route):
+        """What _route_request needs from a route: (handler, max_body, timeout, gate, self_timed, vars,
+        response_class), with the app-wide defaults filled in."""
+        return (route['handler'], route.get('max_body', self.max_body_size),
+                route.get('timeout', self.request_timeout), route.get('gate'), route.get('self_timed'),
+                route.get('vars'), route.get('response_class'))
+
+    def _count_hit(self, route):
+        """Adaptive routing: count a hit, and reorder the table every adaptive_interval of them.
+        The counters aren't locked; a few lost increments don't matter here."""
+        route['hits'] = route.get('hits', 0) + 1
+        self._lookups += 1
+        if self._lookups >= self.adaptive_interval and self._update_lock.acquire(False):
+            try:
+                self._lookups = 0
+                self._reorder()
+            finally:
+                self._update_lock.release()
+
+    def _reorder(self):
+        """Swap in a table sorted by hits, subject to every pair of entries that could both match
+        some request staying in registration order (a topological sort, greedy on hits)."""
+        import heapq
+        base = self._base_table
+        if self._successors is None or self._successors[0] is not base:
+            keys = [(_literal_prefix(e[2]['pattern'].pattern), e[1]) for e in base]
+            self._successors = (base, [[j for j in range(i + 1, len(base)) if _may_overlap(keys[i], keys[j])]
+                                       for i in range(len(base))])
+        successors = self._successors[1]
+        waiting_on = [0] * len(base)
+        for later in successors:
+            for j in later:
+                waiting_on[j] += 1
+        ready = [(-base[i][2].get('hits', 0), i) for i in range(len(base)) if not waiting_on[i]]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            _, i = heapq.heappop(ready)
+            order.append(base[i])
+            for j in successors[i]:
+                waiting_on[j] -= 1
+                if not waiting_on[j]:
+                    heapq.heappush(ready, (-base[j][2].get('hits', 0), j))
+        self._table = tuple(order)
+
+    def route_stats(self):
+        """Per-route counters, keyed by route path."""
+        return dict((r['path'], r['gate'].stats()) for r in self.routes if r.get('gate'))
+
+    def route_hits(self):
+        """Adaptive routing's hit counts, as (path, methods, hits) in the order routes are tried."""
+        return [(e[2]['path'], e[2]['methods'], e[2].get('hits', 0)) for e in self._table]
+
+    def freeze(self):
+        """Compile the route table, with each route's options, and reject any further registration."""
+        with self._update_lock:
+            self.frozen = True
+            self._compile()
+        return self
 
     @staticmethod
     def _route_escape(val):
@@ -235,24 +1999,107 @@ class App(Router):
     def _lookup_route(self, request):
         """Figure out which URL matches."""
         methods_allowed = []
-        for route in self.routes:
-            match = re.match(route['pattern'], request.path)
+        path, method = request.path, request.method
+        for match_fn, methods, route, options in self._table:  # read the current table once
+            match = match_fn(path)
             if match:
-                methods = route.get('methods')
-                if methods and request.method not in methods:
+                if methods and method not in methods:
                     methods_allowed.extend(methods)
                     continue
-                return route, match, match.groupdict()
+                return route, match, match.groupdict(), options
         if methods_allowed:
+            if method == 'OPTIONS':  # no route takes it, so answer it here: no handler, no body
+                allow = ",".join(sorted(set(methods_allowed), key=methods_allowed.index) + ['OPTIONS'])
+                return dict(path=None, handler=self._options_handler, timeout=None, allow=allow), None, {}, None
             raise HttpError(405, headers={'Allow': ",".join(methods_allowed)})
         raise HttpError(404)
 
+    @staticmethod
+    def _options_handler(request, response):
+        return Response(code=204, headers={'Allow': request._route['allow']})
+
+    def _lookup_mount(self, environ):
+        """Find the application mounted at the longest prefix of PATH_INFO, and shift the prefix
+        from PATH_INFO to SCRIPT_NAME (in place) for it. Returns None if nothing is mounted there."""
+        mounts = self.mounts
+        path = environ['PATH_INFO']
+        i = len(path)
+        while i > 0:  # try "/a/b/c", "/a/b", "/a"; a mount never matches partway through a segment
+            application = mounts.get(path[:i])
+            if application is not None:
+                environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + path[:i]
+                environ['PATH_INFO'] = path[i:]
+                return application
+            i = path.rfind('/', 0, i)
+        return None
+
     ### Request Handling ###########################################
     def __call__(self, environ, start_response):
         """WSGI entrypoint."""
-        resp = self.request_handler(Request(environ))
+        if self.mounts:
+            application = self._lookup_mount(environ)
+            if application is not None:  # hand over the child's iterable as-is; no buffering
+                if self.access_log is not None:
+                    return self._logged_mount(application, environ, start_response)
+                return application(environ, start_response)
+        start = _clock() if self.access_log is not None else None
+        request = Request(environ, self)
+        resp = self.request_handler(request)
+        if request._session is not None:  # only requests that touched request.session
+            self.sessions.save(request._session, resp)
         resp._finalize_wsgi(environ, start_response)
-        return resp.response_instance
+        result = resp.response_instance
+        if request._upstreams:  # forwarded responses the handler didn't send free their connections now
+            result = _ClosingIterator(result, _UpstreamBody.close_all, request._upstreams)
+        if resp._deferred:  # run them once the server is completely done with the response
+            result = _ClosingIterator(result, self._run_deferred, resp._deferred)
+        if request.method == 'HEAD':  # headers (Content-Length included) only; never iterate the body
+            result = _ClosingIterator((), getattr(result, 'close', lambda: None))
+        if start is not None:
+            result = _LoggedIterator(result, self.access_log, request, resp.code, start)
+        return result
+
+    def _logged_mount(self, application, environ, start_response):
+        """Call a mounted application, logging the request like our own: make_server() leaves
+        logging to the access log once there is one."""
+        logged = _LoggedIterator((), self.access_log, Request(environ, self), None, _clock())
+
+        def start_logged(status, headers, exc_info=None):
+            logged.status = int(status.split(' ', 1)[0])
+            return start_response(status, headers, exc_info) if exc_info else start_response(status, headers)
+        logged.iterable = application(environ, start_logged)
+        return logged
+
+    def _run_deferred(self, calls):
+        if self._background_pool is None:
+            with self._update_lock:
+                if self._background_pool is None:
+                    self._background_pool = _WorkerPool(self.background_workers, self.background_queue)
+        for call in calls:
+            if self._background_pool.submit(self._run_background, *call) is None:
+                if self.background_overflow == 'inline':
+                    self._run_background(*call)
+                else:
+                    sys.stderr.write("Background queue full; dropped deferred call to %r\n" % (call[0],))
+
+    @staticmethod
+    def _run_background(fn, args, kwargs):
+        try:
+            fn(*args, **kwargs)
+        except Exception:
+            import traceback
+            sys.stderr.write("Deferred call to %r failed:\n%s" % (fn, traceback.format_exc()))
+
+    def shutdown(self, timeout=None):
+        """Wait for deferred calls to finish, then for the access log to be written.
+        Returns False if timeout ran out first."""
+        end = None if timeout is None else _clock() + timeout
+        if self._process_pool is not None:  # without a timeout, wait for the calls it has
+            self._process_pool.shutdown(wait=timeout is None)
+            self._process_pool = None
+        if self._background_pool is not None and not self._background_pool.drain(timeout):
+            return False
+        return self.access_log is None or self.access_log.flush(None if end is None else max(0, end - _clock()))
 
     def request_handler(self, request):
         """Top-level request handler."""
@@ -260,42 +2107,97 @@ class App(Router):
 
     def _route_request(self, request, response):
         """Route and handle request (can raise HttpErrors)."""
-        route, match, url_args = self._lookup_route(request)
-        request.vars.update(url_args)
-        if route.get('vars'):
-            request.vars.update(route['vars'])
-        request._route_match = match
-        if route.get('response_class'):
-            response = route['response_class']()
-        return route['handler'](request, response)
+        route, match, url_args, options = self._lookup_route(request)
+        if self.adaptive_routing and match is not None:
+            self._count_hit(route)
+        handler, max_body, timeout, gate, self_timed, route_vars, response_class = \
+            options or self._route_options(route)
+        if max_body is not None:  # checked before anything reads wsgi.input
+            try:
+                length = int(request.environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                raise HttpError(400)
+            if length > max_body:
+                raise HttpError(413)
+        if timeout is not None:
+            request.deadline = _clock() + timeout
+        batched = 'tinyaf.batch' in request.environ
+        if batched and request.environ['tinyaf.deadline'] is not None:  # the batch's own deadline is the limit
+            request.deadline = min(request.deadline or float('inf'), request.environ['tinyaf.deadline'])
+        if gate is not None:
+            gate.enter()  # raises a 503 right away if the route is saturated
+        try:
+            request.vars.update(url_args)
+            if route_vars:
+                request.vars.update(route_vars)
+            request._route_match, request._route = match, route
+            if response_class:
+                response = response_class()
+            if request.deadline is None or self_timed or batched:
+                # Async and process handlers time out by themselves; a batch's sub-requests run inline,
+                # since the batch itself may hold a deadline worker they'd otherwise wait for.
+                return handler(request, response)
+            gate, gated = None, gate  # the slot is now released when the handler actually returns
+            return self._call_with_deadline(handler, request, response, gated)
+        finally:
+            if gate is not None:
+                gate.exit()
+
+    def _call_with_deadline(self, handler, request, response, gate=None):
+        """Run the handler on a worker thread; give up on it with a 504 if the deadline passes."""
+        abandoned, skipped = [], object()
+        def call():
+            try:
+                if abandoned or not request.time_remaining():  # too late: don't run it after the 504
+                    return skipped
+                return handler(request, response)
+            finally:
+                if gate is not None: gate.exit()
+        if self._deadline_pool is None:
+            with self._update_lock:
+                if self._deadline_pool is None:
+                    self._deadline_pool = _WorkerPool(self.timeout_workers, self.timeout_queue)
+        task = self._deadline_pool.submit(call)
+        if task is None:
+            if gate is not None: gate.exit()
+            raise HttpError(503)
+        if not task.done.wait(request.time_remaining()) or task.value is skipped:
+            abandoned.append(True)
+            with self._update_lock:
+                self.timeouts += 1
+            raise HttpError(504)
+        return task.result()
 
     def _get_response_handled(self, fn, request, response):
         """Try/catch on a response fetcher, call error handler."""
-        try:
-            return self._get_response(fn, request, response)
-        except HttpError as e:
-            return self._get_response_handled(self.error_handler, request, e)
-        except Exception as e:
-            http_error = HttpError(500)
-            http_error.traceback = traceback.format_exc()
-            http_error.exception = e
-            if self.tracebacks_to_stderr:
-                sys.stderr.write(http_error.traceback)
-            return self._get_response(self.error_handler, request, http_error)
+        for _ in range(10):  # an HttpError raised by an error handler goes to the error handler too
+            try:
+                return self._get_response(fn, request, response)
+            except HttpError as e:
+                fn, response = self.error_handler, _carry_deferred(response, e)
+            except Exception as e:
+                http_error = _carry_deferred(response, HttpError(500))
+                http_error.exc_info = sys.exc_info()  # formatted only if someone reads .traceback
+                http_error.exception = e
+                if self.tracebacks_to_stderr:
+                    if self.access_log is not None: self.access_log.error(http_error.exc_info)
+                    else: sys.stderr.write(http_error.traceback)
+                return self._get_response(self.error_handler, request, http_error)
+        return response  # error handlers that keep raising; send the last error as it is
 
     def _get_response(self, fn, request, response):
         """Sort out the response/result ambiguity, and return the response."""
         result = fn(request, response)
         if result:
-            if isinstance(result, Response): response = result
+            if isinstance(result, Response): response = _carry_deferred(response, result)
             else: response.write(result)
         return response
 
     def error_handler(self, request, http_error):
         """Top-level error handler. Override to incercept every error."""
-        route = self.errorhandlers.get(int(http_error.code))
-        if route:
-            return route['handler'](request, http_error)
+        handler = self._error_handlers.get(int(http_error.code))
+        if handler:
+            return handler(request, http_error)
         return self._default_error_handler(request, http_error)
 
     def _default_error_handler(self, request, http_error):
@@ -305,19 +2207,31 @@ class App(Router):
             http_error.headers['Content-type'] = 'text/plain'
             http_error.write("An error occurred:\n\n %s" % (http_error.traceback))
             return
-        http_error.headers['Content-type'] = 'text/html'
-        phrase, description = http_error.http_status()
-        http_error.write("<h1>HTTP %s - %s</h1>" % (http_error.code, phrase))
-        http_error.write("<p>%s.</p>\n" % (description or "Your request could not be processed"))
+        key = (http_error.code, http_error.charset)
         if http_error.code == 405:
-            http_error.write("<p><b>Methods allowed:</b> %s</p>\n" % (http_error.headers['Allow']))
-            http_error.write("<p><b>Method used:</b> %s</p>\n" % (request.method))
+            key += (http_error.headers['Allow'], request.method)
+        page = _ERROR_PAGES.get(key)
+        if page is None:
+            phrase, description = http_error.http_status()
+            page = "<h1>HTTP %s - %s</h1><p>%s.</p>\n" % (
+                http_error.code, phrase, description or "Your request could not be processed")
+            if http_error.code == 405:
+                page += "<p><b>Methods allowed:</b> %s</p>\n<p><b>Method used:</b> %s</p>\n" % (
+                    key[2], key[3])
+            page = page.encode(http_error.charset)
+            if len(_ERROR_PAGES) < 1024:  # bounded, since 405 keys include the client's method
+                _ERROR_PAGES[key] = page
+        http_error.content = [page]
 
     def make_server(self, port=8080, host='', threaded=True):
+        import wsgiref.simple_server
+        if sys.version_info[0] == 2: import SocketServer as socketserver  # pylint: disable=E0401
+        else: import socketserver
         svr = wsgiref.simple_server.WSGIServer
         if threaded:  # Add threading mix-in
             svr = type('ThreadedServer', (socketserver.ThreadingMixIn, svr), {'daemon_threads': True})
-        return wsgiref.simple_server.make_server(host, port, self, server_class=svr)
+        return wsgiref.simple_server.make_server(host, port, self, server_class=svr,
+                                                 handler_class=_server_request_handler())
 
     def serve_forever(self, port=8080, host='', threaded=True):
         print("Serving on %s:%s -- ctrl+c to quit." % (host, port))
@@ -325,3 +2239,4 @@ class App(Router):
             self.make_server(port, host, threaded).serve_forever()
         except KeyboardInterrupt:
             pass
+        self.shutdown()